@@ -5,22 +5,37 @@ Versión robusta optimizada para ejecuciones múltiples con limpieza de datos in
 """
 
 import boto3
+import heapq
 import json
 import os
+import random
 import argparse
 import logging
+import queue
+import threading
 import time
 from datetime import datetime, timedelta
 import uuid
+from collections import Counter
+from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from botocore.config import Config
 from botocore.exceptions import ClientError
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
+# orjson es opcional: parsea/serializa ~3-5x más rápido que el json estándar,
+# relevante cuando el archivo de combinaciones crece
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Configuración de logging
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s - %(levelname)s - %(message)s",
     handlers=[
-        logging.FileHandler("register_combinations.log"),
+        logging.FileHandler("register_combinations.log", delay=True),
         logging.StreamHandler(),
     ],
 )
@@ -29,10 +44,318 @@ logger = logging.getLogger(__name__)
 # Constantes
 MAX_SCAN_ITEMS = 100  # Número máximo de elementos por operación de escaneo DynamoDB
 CLEANUP_HOURS_THRESHOLD = 8  # Horas después de las cuales un estado intermedio se considera inconsistente
+TRANSACT_MAX_ITEMS = 100  # Límite de elementos por llamada TransactWriteItems
+STATUS_INDEX_NAME = "status-index"  # GSI con status como clave de partición
+PARALLEL_SCAN_SEGMENTS = 8  # Segmentos concurrentes para escaneos de tabla completa
+REGISTER_MAX_WORKERS = 32  # Peticiones de registro concurrentes contra DynamoDB
+BATCH_GET_MAX_KEYS = 100  # Límite de claves por llamada BatchGetItem
+BATCH_GET_MAX_RETRIES = 5  # Reintentos de UnprocessedKeys antes de desistir
+
+# Configuración compartida de botocore: reintentos adaptativos ante throttling,
+# timeouts acotados (los valores por defecto son de 60 s) y pool de conexiones
+# dimensionado para la concurrencia de registro y escaneo. El modo adaptativo
+# reintenta con backoff exponencial y jitter los códigos transitorios de
+# DynamoDB (ProvisionedThroughputExceeded, Throttling, InternalServerError...)
+# y además limita el ritmo de emisión del cliente; 10 intentos dan margen para
+# absorber ráfagas de throttling en vez de perder escrituras
+BOTO_CONFIG = Config(
+    max_pool_connections=50,
+    retries={"mode": "adaptive", "total_max_attempts": 10},
+    connect_timeout=5,
+    read_timeout=10,
+    tcp_keepalive=True,
+)
+
+
+class AwsContext:
+    """
+    Contexto AWS compartido: una única sesión boto3 con clientes perezosos.
+
+    Construir un cliente o resource carga los modelos JSON del servicio
+    (decenas de ms); compartir una instancia entre funciones evita repetir
+    ese coste y reutiliza el pool de conexiones HTTP entre llamadas.
+    """
+
+    def __init__(self, region="eu-west-1"):
+        self.region = region
+        self.session = boto3.Session(region_name=region)
+        self._dynamodb = None
+        self._step_functions = None
+        self._s3 = None
+
+    @property
+    def dynamodb(self):
+        if self._dynamodb is None:
+            self._dynamodb = self.session.resource("dynamodb", config=BOTO_CONFIG)
+        return self._dynamodb
+
+    @property
+    def step_functions(self):
+        if self._step_functions is None:
+            self._step_functions = self.session.client("stepfunctions", config=BOTO_CONFIG)
+        return self._step_functions
+
+    @property
+    def s3(self):
+        if self._s3 is None:
+            self._s3 = self.session.client("s3", config=BOTO_CONFIG)
+        return self._s3
+
+
+# (De)serializadores de atributos DynamoDB compartidos: la capa resource crea
+# uno por petición; reutilizarlos evita ese coste en los caminos calientes con
+# el cliente de bajo nivel
+_SERIALIZER = TypeSerializer()
+_DESERIALIZER = TypeDeserializer()
+
+# Contextos compartidos por región para el modo CLI
+_AWS_CONTEXTS = {}
+
+
+def get_aws_context(region="eu-west-1"):
+    """Devuelve el contexto AWS compartido para una región."""
+    context = _AWS_CONTEXTS.get(region)
+    if context is None:
+        context = _AWS_CONTEXTS[region] = AwsContext(region)
+    return context
+
+
+def _json_dumps(obj, indent=False):
+    """
+    Serializa a JSON usando orjson cuando está disponible.
+
+    default=str cubre los tipos que la capa resource de DynamoDB devuelve y
+    que el codificador no conoce (Decimal en los contadores de reintentos).
+    """
+    if orjson:
+        option = orjson.OPT_INDENT_2 if indent else 0
+        return orjson.dumps(obj, option=option, default=str).decode()
+    return json.dumps(obj, indent=2 if indent else None, default=str)
+
+
+def parallel_scan(table, segments=PARALLEL_SCAN_SEGMENTS, **scan_kwargs):
+    """
+    Escanea una tabla DynamoDB en paralelo usando segmentos.
+
+    Divide el escaneo en `segments` segmentos concurrentes (TotalSegments/
+    Segment) ejecutados en un ThreadPoolExecutor, y produce los elementos a
+    medida que llegan en lugar de esperar cada página de forma secuencial.
+
+    Args:
+        table: Tabla DynamoDB a escanear
+        segments: Número de segmentos concurrentes
+        **scan_kwargs: Argumentos adicionales para table.scan
+
+    Yields:
+        dict: Elementos de la tabla
+    """
+    results = queue.Queue()
+    _segment_done = object()  # Centinela de fin de segmento
+
+    # Cliente de bajo nivel: evita la capa de marshalling por petición de la
+    # interfaz resource; los atributos se deserializan una vez por elemento
+    client = table.meta.client
+    table_name = table.name
+
+    def scan_segment(segment):
+        kwargs = dict(scan_kwargs, Segment=segment, TotalSegments=segments)
+
+        try:
+            while True:
+                response = client.scan(TableName=table_name, **kwargs)
+                for item in response.get("Items", []):
+                    results.put({k: _DESERIALIZER.deserialize(v) for k, v in item.items()})
+
+                last_evaluated_key = response.get("LastEvaluatedKey")
+                if not last_evaluated_key:
+                    return
+                kwargs["ExclusiveStartKey"] = last_evaluated_key
+        finally:
+            results.put(_segment_done)
+
+    with ThreadPoolExecutor(max_workers=min(segments, 16)) as executor:
+        futures = [executor.submit(scan_segment, s) for s in range(segments)]
+
+        remaining = len(futures)
+        while remaining:
+            item = results.get()
+            if item is _segment_done:
+                remaining -= 1
+                continue
+            yield item
+
+        # Propagar errores de los segmentos
+        for future in futures:
+            future.result()
+
+
+# Tablas en las que ya se comprobó que el GSI de estado no existe (desplegadas
+# antes de añadirlo): las llamadas siguientes van directas al escaneo con
+# filtro sin pagar una Query condenada a fallar
+_TABLES_WITHOUT_STATUS_INDEX = set()
+
+
+def query_items_by_status(state_table, status, limit=None, projection=None):
+    """
+    Obtiene los elementos con un estado dado usando el índice status-index.
+
+    Consulta el GSI para leer solo los elementos que interesan en lugar de
+    escanear (y pagar) la tabla completa con un FilterExpression. Si el índice
+    no está disponible (tablas desplegadas antes de añadirlo), recurre al
+    escaneo con filtro original.
+
+    Args:
+        state_table: Tabla DynamoDB de estado
+        status: Estado a consultar (p.ej. "pending", "failed")
+        limit: Número máximo de elementos a devolver (None = sin límite)
+        projection: ProjectionExpression opcional para transferir solo los
+            atributos necesarios (admite el alias #s para status)
+
+    Yields:
+        dict: Elementos con el estado solicitado, página a página, sin
+            materializar el resultado completo en memoria
+    """
+    # Un límite de 0 (o negativo) significa "nada que devolver", no "sin
+    # límite"; distinguirlo de None evita arrancar todo lo pendiente
+    if limit is not None and limit <= 0:
+        return
+
+    yielded = 0
+    last_evaluated_key = None
+
+    # Solo Limit y ExclusiveStartKey cambian entre páginas; el resto de la
+    # petición se construye una única vez
+    base_query_kwargs = {
+        "IndexName": STATUS_INDEX_NAME,
+        "KeyConditionExpression": Key("status").eq(status),
+    }
+    if projection:
+        base_query_kwargs["ProjectionExpression"] = projection
+        if "#s" in projection:
+            base_query_kwargs["ExpressionAttributeNames"] = {"#s": "status"}
+
+    if state_table.name not in _TABLES_WITHOUT_STATUS_INDEX:
+        try:
+            while True:
+                query_kwargs = dict(
+                    base_query_kwargs,
+                    Limit=min(MAX_SCAN_ITEMS, limit - yielded)
+                    if limit is not None
+                    else MAX_SCAN_ITEMS,
+                )
+
+                if last_evaluated_key:
+                    query_kwargs["ExclusiveStartKey"] = last_evaluated_key
+
+                response = state_table.query(**query_kwargs)
+                for item in response.get("Items", []):
+                    yield item
+                    yielded += 1
+                    if limit is not None and yielded >= limit:
+                        return
+
+                last_evaluated_key = response.get("LastEvaluatedKey")
+                if not last_evaluated_key:
+                    return
+
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("ValidationException", "ResourceNotFoundException"):
+                raise
+            _TABLES_WITHOUT_STATUS_INDEX.add(state_table.name)
+            logger.warning(f"Índice {STATUS_INDEX_NAME} no disponible, usando Scan con filtro")
+
+    # Camino de respaldo: escaneo con FilterExpression sobre status
+    last_evaluated_key = None
+    base_scan_kwargs = {
+        "FilterExpression": "#s = :status",
+        "ExpressionAttributeNames": {"#s": "status"},
+        "ExpressionAttributeValues": {":status": status},
+        "Limit": MAX_SCAN_ITEMS,
+    }
+    if projection:
+        base_scan_kwargs["ProjectionExpression"] = projection
+
+    while True:
+        if last_evaluated_key:
+            scan_kwargs = dict(base_scan_kwargs, ExclusiveStartKey=last_evaluated_key)
+        else:
+            scan_kwargs = base_scan_kwargs
+
+        response = state_table.scan(**scan_kwargs)
+        for item in response.get("Items", []):
+            yield item
+            yielded += 1
+            if limit is not None and yielded >= limit:
+                return
+
+        last_evaluated_key = response.get("LastEvaluatedKey")
+        if not last_evaluated_key:
+            return
+
+
+def _apply_reset_updates(dyn_client, updates):
+    """
+    Aplica actualizaciones de reset en lotes mediante TransactWriteItems.
+
+    Agrupa las actualizaciones en transacciones de hasta 100 elementos (el
+    límite actual de la API) para amortizar las idas y vueltas a DynamoDB,
+    ⌈N/100⌉ llamadas en lugar de N. Si una transacción se cancela
+    (por ejemplo, porque la condición de un elemento falla), reintenta los
+    elementos de ese lote de forma individual para no descartar el resto.
+
+    Args:
+        dyn_client: Cliente de bajo nivel de DynamoDB
+        updates: Lista de entradas "Update" para TransactWriteItems
+
+    Returns:
+        int: Número de actualizaciones aplicadas
+    """
+    applied = 0
+
+    for start in range(0, len(updates), TRANSACT_MAX_ITEMS):
+        chunk = updates[start:start + TRANSACT_MAX_ITEMS]
+
+        try:
+            dyn_client.transact_write_items(
+                TransactItems=[{"Update": update} for update in chunk]
+            )
+            applied += len(chunk)
+        except ClientError as e:
+            logger.warning(f"Transacción de reset cancelada, reintentando elementos individualmente: {str(e)}")
+
+            for update in chunk:
+                combo_id = update["Key"]["id"]["S"]
+                try:
+                    dyn_client.update_item(**update)
+                    applied += 1
+                except ClientError as inner_e:
+                    if inner_e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                        logger.warning(f"Condición fallida al restablecer {combo_id}")
+                    else:
+                        logger.error(f"Error al restablecer {combo_id}: {str(inner_e)}")
+
+    return applied
+
+
+# Caché de validación de tablas: {nombre: (resultado, expiración)}
+_TABLE_STATUS_CACHE = {}
+TABLE_STATUS_CACHE_TTL = 300  # Segundos de validez del resultado de DescribeTable
 
 
 def validate_table(dynamodb, table_name):
-    """Valida que la tabla DynamoDB existe y está activa."""
+    """Valida que la tabla DynamoDB existe y está activa.
+
+    El resultado se cachea unos minutos para no pagar un DescribeTable por
+    cada punto de entrada del script. Con SKIP_TABLE_VALIDATION=1 se omite
+    la llamada por completo (útil cuando la tabla se sabe estable).
+    """
+    if os.environ.get("SKIP_TABLE_VALIDATION") == "1":
+        return True
+
+    cached = _TABLE_STATUS_CACHE.get(table_name)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+
     try:
         table = dynamodb.Table(table_name)
         response = table.meta.client.describe_table(TableName=table_name)
@@ -41,8 +364,9 @@ def validate_table(dynamodb, table_name):
         if table_status != "ACTIVE":
             logger.warning(f"La tabla {table_name} existe pero no está activa (estado: {table_status})")
             return False
-            
+
         logger.info(f"Tabla {table_name} verificada: ACTIVE")
+        _TABLE_STATUS_CACHE[table_name] = (True, time.monotonic() + TABLE_STATUS_CACHE_TTL)
         return True
     except ClientError as e:
         if e.response["Error"]["Code"] == "ResourceNotFoundException":
@@ -52,32 +376,47 @@ def validate_table(dynamodb, table_name):
         return False
 
 
+# Campos requeridos de una combinación y resultado de validación exitosa,
+# precomputados para no reconstruirlos en cada llamada del bucle caliente
+_REQUIRED_FIELDS = ("P_EMPRESA", "P_CONTR", "P_VERSION")
+_VALID_OK = (True, "")
+
+# Conjuntos de estados precomputados para chequeos de pertenencia O(1) sin
+# re-alocar una lista en cada iteración
+_VALID_STATUSES = frozenset({"pending", "preprocessing", "processing", "completed", "failed"})
+_INTERMEDIATE_STATUSES = frozenset({"preprocessing", "processing"})
+_STABLE_STATUSES = frozenset({"pending", "processing", "completed"})
+
+
 def validate_combination(combo):
     """
     Valida rigurosamente que una combinación tenga todos los campos requeridos y tipos correctos.
-    
+
     Args:
         combo: Diccionario con los datos de la combinación
-        
+
     Returns:
         tuple: (bool, str) - Indica si la combinación es válida y un mensaje de error si no lo es
     """
-    required_fields = ["P_EMPRESA", "P_CONTR", "P_VERSION"]
-    
     # Verificar que todos los campos requeridos existan
-    for field in required_fields:
+    for field in _REQUIRED_FIELDS:
+        value = combo.get(field)
+
+        # Camino rápido: string no vacío (el caso habitual)
+        if type(value) is str and value:
+            continue
+
         if field not in combo:
             return False, f"Campo requerido {field} no encontrado"
-        
+
         # Validar que no esté vacío
-        if not combo[field]:
+        if not value:
             return False, f"Campo {field} está vacío"
-            
+
         # Si es necesario, verificar tipo (aquí asumimos que todos son strings)
-        if not isinstance(combo[field], str):
-            combo[field] = str(combo[field])  # Convertir a string si no lo es
-    
-    return True, ""
+        combo[field] = str(value)  # Convertir a string si no lo es
+
+    return _VALID_OK
 
 
 def clean_inconsistent_data(state_table):
@@ -91,190 +430,274 @@ def clean_inconsistent_data(state_table):
         dict: Estadísticas de limpieza {deleted: X, reset: Y}
     """
     stats = {"deleted": 0, "reset": 0}
-    last_evaluated_key = None
-    
+
     logger.info("Iniciando limpieza de datos inconsistentes...")
-    
+
     # Calculamos el umbral de tiempo para estados intermedios
     threshold_time = datetime.now() - timedelta(hours=CLEANUP_HOURS_THRESHOLD)
     threshold_time_str = threshold_time.isoformat()
-    
-    # Escaneamos toda la tabla con paginación
-    while True:
-        scan_kwargs = {
-            "Limit": MAX_SCAN_ITEMS
-        }
+
+    # Acumular limpiezas para aplicarlas en lote al final
+    to_reset = []   # Pares (id, razón) a restablecer
+    to_delete = []  # IDs a eliminar
+
+    # Escaneamos toda la tabla en paralelo por segmentos, transfiriendo solo
+    # los atributos que se inspeccionan
+    for item in parallel_scan(
+        state_table,
+        Limit=MAX_SCAN_ITEMS,
+        ProjectionExpression="id, #s, started_at, P_EMPRESA, P_CONTR, P_VERSION",
+        ExpressionAttributeNames={"#s": "status"},
+    ):
+        item_id = item.get("id", "unknown")
+        is_inconsistent = False
+        inconsistency_reason = ""
         
-        if last_evaluated_key:
-            scan_kwargs["ExclusiveStartKey"] = last_evaluated_key
-            
-        response = state_table.scan(**scan_kwargs)
-        items = response.get("Items", [])
+        # 1. Verificar campos requeridos
+        required_fields = ["P_EMPRESA", "P_CONTR", "P_VERSION", "status"]
+        for field in required_fields:
+            if field not in item or not item[field]:
+                is_inconsistent = True
+                inconsistency_reason = f"Falta campo {field}"
+                break
         
-        for item in items:
-            item_id = item.get("id", "unknown")
-            is_inconsistent = False
-            inconsistency_reason = ""
-            
-            # 1. Verificar campos requeridos
-            required_fields = ["P_EMPRESA", "P_CONTR", "P_VERSION", "status"]
-            for field in required_fields:
-                if field not in item or not item[field]:
+        # 2. Verificar estados intermedios bloqueados
+        if not is_inconsistent and item.get("status") in _INTERMEDIATE_STATUSES:
+            # Si tiene timestamp de inicio y ha estado en ese estado por más
+            # tiempo del umbral. Las fechas ISO-8601 ordenan lexicográficamente,
+            # así que basta comparar strings sin parsear un datetime por registro
+            started_at = item.get("started_at")
+            if isinstance(started_at, str) and started_at:
+                if started_at < threshold_time_str:
                     is_inconsistent = True
-                    inconsistency_reason = f"Falta campo {field}"
-                    break
-            
-            # 2. Verificar estados intermedios bloqueados
-            if not is_inconsistent and item.get("status") in ["preprocessing", "processing"]:
-                # Si tiene timestamp de inicio y ha estado en ese estado por más tiempo del umbral
-                if "started_at" in item:
-                    try:
-                        started_at = datetime.fromisoformat(item["started_at"].replace('Z', '+00:00'))
-                        if started_at < threshold_time:
-                            is_inconsistent = True
-                            inconsistency_reason = f"Estado {item['status']} por más de {CLEANUP_HOURS_THRESHOLD}h"
-                    except (ValueError, TypeError):
-                        # Si el formato de fecha no es válido
-                        is_inconsistent = True
-                        inconsistency_reason = "Timestamp started_at inválido"
-                else:
-                    # Si no tiene timestamp de inicio, también es inconsistente
-                    is_inconsistent = True
-                    inconsistency_reason = f"Estado {item['status']} sin timestamp"
-            
-            # 3. Verificar estados desconocidos
-            if not is_inconsistent and item.get("status") not in ["pending", "preprocessing", "processing", "completed", "failed"]:
+                    inconsistency_reason = f"Estado {item['status']} por más de {CLEANUP_HOURS_THRESHOLD}h"
+            elif "started_at" in item:
+                # Timestamp vacío o de tipo inesperado
                 is_inconsistent = True
-                inconsistency_reason = f"Estado desconocido: {item.get('status')}"
-            
-            # Limpiar registros inconsistentes
-            if is_inconsistent:
-                try:
-                    # Determinar si eliminar o resetear
-                    # Para mantener el historial, preferimos resetear en lugar de eliminar
-                    if item.get("status") in ["preprocessing", "processing"]:
-                        # Resetear a pendiente
-                        state_table.update_item(
-                            Key={"id": item_id},
-                            UpdateExpression="SET #s = :pending, reset_at = :now, reset_reason = :reason, retries = if_not_exists(retries, :zero) + :one",
-                            ExpressionAttributeNames={"#s": "status"},
-                            ExpressionAttributeValues={
-                                ":pending": "pending",
-                                ":now": datetime.now().isoformat(),
-                                ":reason": inconsistency_reason,
-                                ":zero": 0,
-                                ":one": 1
-                            },
-                        )
-                        stats["reset"] += 1
-                        logger.info(f"Restablecido registro inconsistente: {item_id} - Razón: {inconsistency_reason}")
-                    else:
-                        # Para otras inconsistencias graves, eliminar
-                        state_table.delete_item(Key={"id": item_id})
-                        stats["deleted"] += 1
-                        logger.info(f"Eliminado registro inconsistente: {item_id} - Razón: {inconsistency_reason}")
-                        
-                except Exception as e:
-                    logger.error(f"Error al limpiar registro inconsistente {item_id}: {str(e)}")
+                inconsistency_reason = "Timestamp started_at inválido"
+            else:
+                # Si no tiene timestamp de inicio, también es inconsistente
+                is_inconsistent = True
+                inconsistency_reason = f"Estado {item['status']} sin timestamp"
         
-        # Verificar si hay más elementos que escanear
-        last_evaluated_key = response.get("LastEvaluatedKey")
-        if not last_evaluated_key:
-            break
+        # 3. Verificar estados desconocidos
+        if not is_inconsistent and item.get("status") not in _VALID_STATUSES:
+            is_inconsistent = True
+            inconsistency_reason = f"Estado desconocido: {item.get('status')}"
+        
+        # Clasificar registros inconsistentes para limpieza en lote
+        if is_inconsistent:
+            # Determinar si eliminar o resetear
+            # Para mantener el historial, preferimos resetear en lugar de eliminar
+            if item.get("status") in _INTERMEDIATE_STATUSES:
+                to_reset.append((item_id, inconsistency_reason))
+                logger.info("Restableciendo registro inconsistente: %s - Razón: %s", item_id, inconsistency_reason)
+            else:
+                # Para otras inconsistencias graves, eliminar
+                to_delete.append(item_id)
+                logger.info("Eliminando registro inconsistente: %s - Razón: %s", item_id, inconsistency_reason)
+
+    # Aplicar eliminaciones en lotes de 25 vía batch_writer
+    if to_delete:
+        try:
+            with state_table.batch_writer() as batch:
+                for item_id in to_delete:
+                    batch.delete_item(Key={"id": item_id})
+            stats["deleted"] += len(to_delete)
+        except Exception as e:
+            logger.error(f"Error al eliminar registros inconsistentes en lote: {str(e)}")
+
+    # Aplicar resets mediante TransactWriteItems en lotes de TRANSACT_MAX_ITEMS
+    if to_reset:
+        now = datetime.now().isoformat()
+        updates = [
+            {
+                "TableName": state_table.name,
+                "Key": {"id": {"S": item_id}},
+                "UpdateExpression": "SET #s = :pending, reset_at = :now, reset_reason = :reason, retries = if_not_exists(retries, :zero) + :one",
+                "ExpressionAttributeNames": {"#s": "status"},
+                "ExpressionAttributeValues": {
+                    ":pending": {"S": "pending"},
+                    ":now": {"S": now},
+                    ":reason": {"S": reason},
+                    ":zero": {"N": "0"},
+                    ":one": {"N": "1"},
+                },
+            }
+            for item_id, reason in to_reset
+        ]
+        stats["reset"] += _apply_reset_updates(state_table.meta.client, updates)
+
     
     logger.info(f"Limpieza completada: {stats['deleted']} eliminados, {stats['reset']} restablecidos")
     return stats
 
 
-def register_combination_atomic(state_table, combo):
+def _batch_get_existing_statuses(client, table_name, combo_ids):
+    """
+    Obtiene el estado actual de un conjunto de combinaciones vía BatchGetItem.
+
+    Agrupa las claves en lotes de hasta 100 (el límite de la API), de modo que
+    detectar N duplicados cuesta ⌈N/100⌉ idas y vueltas en lugar de N GetItems.
+    Las claves no procesadas (UnprocessedKeys) se reintentan con backoff
+    exponencial y jitter hasta BATCH_GET_MAX_RETRIES veces; si persisten, las
+    restantes se resuelven por el camino normal del PutItem condicional.
+
+    Args:
+        client: Cliente de bajo nivel de DynamoDB
+        table_name: Nombre de la tabla de estado
+        combo_ids: Iterable de identificadores de combinación
+
+    Returns:
+        dict: Mapa {combo_id: status} con los registros ya existentes
+    """
+    existing = {}
+
+    combo_ids = list(combo_ids)
+    for start in range(0, len(combo_ids), BATCH_GET_MAX_KEYS):
+        request = {
+            table_name: {
+                "Keys": [
+                    {"id": {"S": combo_id}}
+                    for combo_id in combo_ids[start:start + BATCH_GET_MAX_KEYS]
+                ],
+                "ProjectionExpression": "id, #s",
+                "ExpressionAttributeNames": {"#s": "status"},
+            }
+        }
+
+        attempt = 0
+        while request:
+            response = client.batch_get_item(RequestItems=request)
+            for item in response.get("Responses", {}).get(table_name, []):
+                existing[item["id"]["S"]] = item.get("status", {}).get("S", "unknown")
+            request = response.get("UnprocessedKeys") or None
+
+            if request:
+                attempt += 1
+                if attempt > BATCH_GET_MAX_RETRIES:
+                    # La pre-pasada es solo una optimización: las claves que
+                    # queden sin resolver siguen el camino del PutItem
+                    # condicional, igual que cuando no hay pre-pasada
+                    logger.warning(
+                        f"BatchGetItem sigue devolviendo claves sin procesar tras "
+                        f"{BATCH_GET_MAX_RETRIES} reintentos; se continúa sin ellas"
+                    )
+                    break
+                # Backoff exponencial con jitter: los UnprocessedKeys llegan en
+                # respuestas 200, así que el modo adaptativo del SDK no los
+                # espacia y hay que hacerlo aquí para no martillear la tabla
+                time.sleep(random.uniform(0, min(2.0, 0.05 * (2**attempt))))
+
+    return existing
+
+
+def register_combination_atomic(state_table, combo, combo_id=None, now_iso=None, known_exists=False):
     """
     Registra una combinación de manera atómica, asegurando que no haya duplicados
     ni condiciones de carrera.
-    
+
     Args:
         state_table: Tabla DynamoDB de estado
         combo: Diccionario con datos de la combinación
-    
+        combo_id: Identificador precomputado de la combinación (opcional)
+        now_iso: Timestamp ISO precomputado del lote (opcional); evita formatear
+            la hora una vez por registro cuando se procesan miles
+        known_exists: True si una pre-pasada de BatchGetItem ya confirmó que el
+            registro existe; se salta el PutItem condicional, que fallaría
+
     Returns:
         tuple: (str, str) - Estado de registro y mensaje
     """
-    combo_id = f"{combo['P_EMPRESA']}_{combo['P_CONTR']}_{combo['P_VERSION']}"
-    
+    if combo_id is None:
+        combo_id = f"{combo['P_EMPRESA']}_{combo['P_CONTR']}_{combo['P_VERSION']}"
+    if now_iso is None:
+        now_iso = datetime.now().isoformat()
+
+    # Cliente de bajo nivel para saltar el marshalling de la capa resource
+    client = state_table.meta.client
+    table_name = state_table.name
+
+    if not known_exists:
+        try:
+            # Intentar crear directamente con ConditionExpression: en el caso común
+            # (registro nuevo) esto resuelve en una sola ida y vuelta, sin GetItem previo
+            new_item = {
+                "id": combo_id,
+                "P_EMPRESA": combo["P_EMPRESA"],
+                "P_CONTR": combo["P_CONTR"],
+                "P_VERSION": combo["P_VERSION"],
+                "status": "pending",
+                "registered_at": now_iso,
+                "retries": 0
+            }
+            client.put_item(
+                TableName=table_name,
+                Item={k: _SERIALIZER.serialize(v) for k, v in new_item.items()},
+                ConditionExpression="attribute_not_exists(id)"
+            )
+            return "registered", "Registrado exitosamente"
+
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                return "error", f"Error al registrar: {str(e)}"
+        except Exception as e:
+            return "error", f"Error general: {str(e)}"
+
+    # Ya existe: verificar su estado y decidir si restablecer
     try:
-        # Verificar primero si ya existe
-        response = state_table.get_item(Key={"id": combo_id})
-        
+        response = client.get_item(TableName=table_name, Key={"id": {"S": combo_id}})
+
         if "Item" in response:
-            # Ya existe, verificar su estado
             item = response["Item"]
-            current_status = item.get("status", "unknown")
-            
+            current_status = item.get("status", {}).get("S", "unknown")
+
             # Si está en estado fallido, restablecer
             if current_status == "failed":
-                state_table.update_item(
-                    Key={"id": combo_id},
+                client.update_item(
+                    TableName=table_name,
+                    Key={"id": {"S": combo_id}},
                     UpdateExpression="SET #s = :pending, reset_at = :now, retries = if_not_exists(retries, :zero) + :one, error = :null",
                     ExpressionAttributeNames={"#s": "status"},
                     ExpressionAttributeValues={
-                        ":pending": "pending",
-                        ":now": datetime.now().isoformat(),
-                        ":zero": 0,
-                        ":one": 1,
-                        ":null": None
+                        ":pending": {"S": "pending"},
+                        ":now": {"S": now_iso},
+                        ":zero": {"N": "0"},
+                        ":one": {"N": "1"},
+                        ":null": {"NULL": True}
                     },
                 )
                 return "reset", "Restablecido de fallido a pendiente"
             
             # Si está en un estado inconsistente (diferente de pending, processing, completed), restablecer
-            elif current_status not in ["pending", "processing", "completed"]:
-                state_table.update_item(
-                    Key={"id": combo_id},
+            elif current_status not in _STABLE_STATUSES:
+                client.update_item(
+                    TableName=table_name,
+                    Key={"id": {"S": combo_id}},
                     UpdateExpression="SET #s = :pending, reset_at = :now, retries = if_not_exists(retries, :zero) + :one",
                     ExpressionAttributeNames={"#s": "status"},
                     ExpressionAttributeValues={
-                        ":pending": "pending",
-                        ":now": datetime.now().isoformat(),
-                        ":zero": 0,
-                        ":one": 1
+                        ":pending": {"S": "pending"},
+                        ":now": {"S": now_iso},
+                        ":zero": {"N": "0"},
+                        ":one": {"N": "1"}
                     },
                 )
                 return "reset", f"Restablecido de estado {current_status} a pendiente"
             
             # De lo contrario, dejar como está (ya sea pending, processing o completed)
             return "skipped", f"Ya existe con estado: {current_status}"
-        
-        # No existe, crear nuevo registro con ConditionExpression para seguridad adicional
-        state_table.put_item(
-            Item={
-                "id": combo_id,
-                "P_EMPRESA": combo["P_EMPRESA"],
-                "P_CONTR": combo["P_CONTR"],
-                "P_VERSION": combo["P_VERSION"],
-                "status": "pending",
-                "registered_at": datetime.now().isoformat(),
-                "retries": 0
-            },
-            ConditionExpression="attribute_not_exists(id)"
-        )
-        return "registered", "Registrado exitosamente"
-    
+
+        # Condición de carrera: el registro desapareció entre la condición y la verificación
+        return "error", "Error de condición, pero registro no encontrado"
+
     except ClientError as e:
-        if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
-            # Condición de carrera: otro proceso creó el registro entre nuestra verificación y creación
-            # Volver a intentar una vez más
-            try:
-                response = state_table.get_item(Key={"id": combo_id})
-                if "Item" in response:
-                    return "skipped", "Creado por otro proceso concurrente"
-                return "error", "Error de condición, pero registro no encontrado"
-            except Exception as inner_e:
-                return "error", f"Error al verificar después de condición fallida: {str(inner_e)}"
         return "error", f"Error al registrar: {str(e)}"
     except Exception as e:
         return "error", f"Error general: {str(e)}"
 
 
-def log_registration_execution(bucket, registration_summary, combinations_file):
+def log_registration_execution(bucket, registration_summary, combinations_file, aws=None):
     """
     Guarda un log de la ejecución actual en S3.
     
@@ -292,11 +715,15 @@ def log_registration_execution(bucket, registration_summary, combinations_file):
     
     # Guardar el log en S3
     try:
-        s3_client = boto3.client("s3")
+        s3_client = (aws or get_aws_context()).s3
+        if orjson:
+            body = orjson.dumps(log_data, option=orjson.OPT_INDENT_2)
+        else:
+            body = json.dumps(log_data, indent=2)
         s3_client.put_object(
             Bucket=bucket,
             Key=f"GTFS_LOGS/registrations/registration_log_{timestamp}.json",
-            Body=json.dumps(log_data, indent=2),
+            Body=body,
             ContentType="application/json",
         )
         logger.info(f"Log de ejecución guardado en S3: registration_log_{timestamp}.json")
@@ -318,9 +745,9 @@ def register_combinations(
     Registra combinaciones en DynamoDB y opcionalmente inicia su procesamiento.
     Optimizado para múltiples ejecuciones seguras.
     """
-    # Inicializar clientes AWS
-    dynamodb = boto3.resource("dynamodb", region_name=region)
-    step_functions = boto3.client("stepfunctions", region_name=region)
+    # Reutilizar el contexto AWS compartido (sesión y clientes perezosos)
+    aws = get_aws_context(region)
+    dynamodb = aws.dynamodb
 
     # Validar tabla
     if not validate_table(dynamodb, state_table_name):
@@ -335,11 +762,13 @@ def register_combinations(
         cleanup_stats = clean_inconsistent_data(state_table)
         logger.info(f"Limpieza completada: {cleanup_stats['deleted']} eliminados, {cleanup_stats['reset']} restablecidos")
 
-    # Cargar combinaciones desde el archivo JSON
+    # Cargar combinaciones desde el archivo JSON. El buffer crudo se parsea en
+    # línea para que sea recolectable en cuanto existe el dict, en lugar de
+    # retener bytes + estructura parseada durante todo el registro
     try:
-        with open(combinations_file, "r") as f:
-            data = json.load(f)
-            combinations = data.get("combinations", [])
+        with open(combinations_file, "rb") as f:
+            data = orjson.loads(f.read()) if orjson else json.load(f)
+        combinations = data.get("combinations", [])
 
         if not combinations:
             logger.error(f"No se encontraron combinaciones en {combinations_file}")
@@ -351,6 +780,30 @@ def register_combinations(
         logger.error(f"Error al cargar combinaciones: {str(e)}")
         return False
 
+    # Deduplicar dentro del propio archivo: las re-ejecuciones del
+    # descubrimiento pueden repetir entradas y cada duplicado pagaría el ciclo
+    # de registro completo contra DynamoDB; un set local lo resuelve en O(N).
+    # Las entradas sin los campos requeridos pasan tal cual para que la
+    # validación las contabilice como errores igual que antes
+    seen_ids = set()
+    unique_combinations = []
+    for combo in combinations:
+        if all(combo.get(field) for field in _REQUIRED_FIELDS):
+            combo_id = combo.setdefault(
+                "_id", f"{combo['P_EMPRESA']}_{combo['P_CONTR']}_{combo['P_VERSION']}"
+            )
+            if combo_id in seen_ids:
+                continue
+            seen_ids.add(combo_id)
+        unique_combinations.append(combo)
+
+    if len(unique_combinations) != len(combinations):
+        logger.info(
+            "Se descartaron %d entradas duplicadas del archivo de combinaciones",
+            len(combinations) - len(unique_combinations),
+        )
+        combinations = unique_combinations
+
     # Contadores para estadísticas
     stats = {
         "registered": 0,  # Nuevos registros
@@ -360,36 +813,68 @@ def register_combinations(
     }
     processed_combinations = []
 
+    # Timestamp único del lote de registro: formatear la hora una vez en vez
+    # de una por combinación dentro del bucle caliente
+    now_iso = datetime.now().isoformat()
+
+    # Pre-pasada: recuperar en lotes de BatchGetItem el estado de los registros
+    # ya existentes. En re-ejecuciones (el caso común) la mayoría de
+    # combinaciones ya están registradas y se descartan aquí localmente, sin
+    # pagar un PutItem condicional fallido más un GetItem por cada una
+    candidate_ids = [
+        combo.setdefault("_id", f"{combo['P_EMPRESA']}_{combo['P_CONTR']}_{combo['P_VERSION']}")
+        for combo in combinations
+        if all(combo.get(field) for field in _REQUIRED_FIELDS)
+    ]
+    try:
+        existing_statuses = _batch_get_existing_statuses(
+            state_table.meta.client, state_table.name, candidate_ids
+        )
+    except ClientError as e:
+        logger.warning(f"BatchGetItem de duplicados no disponible, registrando sin pre-pasada: {str(e)}")
+        existing_statuses = {}
+
     # Función para procesar una combinación individual
     def process_combination(combo):
         # Validar la combinación
         is_valid, error_msg = validate_combination(combo)
         if not is_valid:
-            logger.error(f"Combinación inválida: {error_msg}")
+            logger.error("Combinación inválida: %s", error_msg)
             return "error", error_msg
-            
-        # Registrar combinación de forma atómica
-        result, message = register_combination_atomic(state_table, combo)
-        combo_id = f"{combo['P_EMPRESA']}_{combo['P_CONTR']}_{combo['P_VERSION']}"
+
+        # Calcular el identificador una sola vez y compartirlo con el resto de usos
+        combo_id = combo["_id"] = f"{combo['P_EMPRESA']}_{combo['P_CONTR']}_{combo['P_VERSION']}"
+
+        # Camino rápido: ya registrada en un estado estable, no hay nada que escribir
+        prior_status = existing_statuses.get(combo_id)
+        if prior_status in _STABLE_STATUSES:
+            return "skipped", f"Ya existe con estado: {prior_status}"
+
+        # Registrar combinación de forma atómica; si la pre-pasada ya vio el
+        # registro (p.ej. en estado fallido), se omite el PutItem condicional
+        # que con certeza fallaría y se va directo a la rama de restablecimiento
+        result, message = register_combination_atomic(
+            state_table, combo, combo_id, now_iso, known_exists=prior_status is not None
+        )
         
-        if result == "registered":
-            logger.info(f"Combinación registrada: {combo_id}")
-        elif result == "reset":
-            logger.info(f"Combinación restablecida: {combo_id} - {message}")
-        elif result == "skipped":
-            logger.info(f"Combinación omitida: {combo_id} - {message}")
+        if result == "error":
+            logger.error("Error registrando combinación %s: %s", combo_id, message)
         else:
-            logger.error(f"Error registrando combinación {combo_id}: {message}")
+            # Detalle por combinación solo en debug: con 32 hilos registrando,
+            # cada línea serializa en el lock de los handlers y el resumen
+            # agregado final ya cubre el caso normal
+            logger.debug("Combinación %s: %s - %s", combo_id, result, message)
             
         return result, message
 
-    # Procesar combinaciones en paralelo para mayor eficiencia
-    with ThreadPoolExecutor(max_workers=10) as executor:
+    # Procesar combinaciones en paralelo para mayor eficiencia; el trabajo es
+    # puramente de red, así que la concurrencia alta no satura CPU
+    with ThreadPoolExecutor(max_workers=REGISTER_MAX_WORKERS) as executor:
         future_to_combo = {executor.submit(process_combination, combo): combo for combo in combinations}
         
         for future in as_completed(future_to_combo):
             combo = future_to_combo[future]
-            combo_id = f"{combo['P_EMPRESA']}_{combo['P_CONTR']}_{combo['P_VERSION']}"
+            combo_id = combo.get("_id") or f"{combo.get('P_EMPRESA')}_{combo.get('P_CONTR')}_{combo.get('P_VERSION')}"
             
             try:
                 result, message = future.result()
@@ -405,7 +890,7 @@ def register_combinations(
                 else:
                     stats["errors"] += 1
             except Exception as e:
-                logger.error(f"Error procesando combinación {combo_id}: {str(e)}")
+                logger.error("Error procesando combinación %s: %s", combo_id, str(e))
                 stats["errors"] += 1
                 processed_combinations.append({
                     "id": combo_id,
@@ -413,9 +898,19 @@ def register_combinations(
                     "message": str(e)
                 })
 
-    # Guardar log de la ejecución
+    # Guardar log de la ejecución sin bloquear el camino principal. El hilo no
+    # es daemon para que un proceso CLI no termine antes de escribir el log; en
+    # Lambda el handler puede congelarse al retornar, así que allí se escribe
+    # en línea
     if bucket_name:
-        log_registration_execution(bucket_name, stats, combinations_file)
+        if os.environ.get("AWS_LAMBDA_FUNCTION_NAME"):
+            log_registration_execution(bucket_name, stats, combinations_file, aws=aws)
+        else:
+            threading.Thread(
+                target=log_registration_execution,
+                args=(bucket_name, stats, combinations_file),
+                kwargs={"aws": aws},
+            ).start()
 
     # Mostrar resumen
     logger.info(f"Registro completado: {stats['registered']} nuevas, {stats['reset']} restablecidas, "
@@ -423,7 +918,7 @@ def register_combinations(
     
     # Si se solicita iniciar procesamiento
     if start_processing and (stats["registered"] + stats["reset"]) > 0:
-        started = trigger_processing(state_table, state_machine_arn, max_to_start)
+        started = trigger_processing(state_table, state_machine_arn, max_to_start, aws=aws)
         if started > 0:
             logger.info(f"Se iniciaron {started} ejecuciones")
         else:
@@ -432,7 +927,7 @@ def register_combinations(
     return stats["registered"] > 0 or stats["reset"] > 0
 
 
-def trigger_processing(state_table, state_machine_arn, max_to_start=1):
+def trigger_processing(state_table, state_machine_arn, max_to_start=1, aws=None):
     """
     Inicia el procesamiento de combinaciones pendientes.
     
@@ -444,38 +939,16 @@ def trigger_processing(state_table, state_machine_arn, max_to_start=1):
     Returns:
         int: Número de ejecuciones iniciadas
     """
-    # Cliente Step Functions
-    step_functions = boto3.client("stepfunctions")
+    # Cliente Step Functions del contexto compartido
+    step_functions = (aws or get_aws_context()).step_functions
     started = 0
     
-    # Función para obtener todas las combinaciones pendientes con paginación
-    def get_all_pending_combinations(limit=MAX_SCAN_ITEMS):
-        pending_combinations = []
-        last_evaluated_key = None
-        
-        while True and len(pending_combinations) < limit:
-            scan_kwargs = {
-                "FilterExpression": "#s = :pending",
-                "ExpressionAttributeNames": {"#s": "status"},
-                "ExpressionAttributeValues": {":pending": "pending"},
-                "Limit": min(MAX_SCAN_ITEMS, limit - len(pending_combinations))
-            }
-            
-            if last_evaluated_key:
-                scan_kwargs["ExclusiveStartKey"] = last_evaluated_key
-                
-            response = state_table.scan(**scan_kwargs)
-            pending_combinations.extend(response.get("Items", []))
-            
-            last_evaluated_key = response.get("LastEvaluatedKey")
-            if not last_evaluated_key or len(pending_combinations) >= limit:
-                break
-                
-        return pending_combinations
-
     try:
-        # Obtener combinaciones pendientes
-        pending_combinations = get_all_pending_combinations(max_to_start)
+        # Obtener combinaciones pendientes vía el GSI de estado (acotadas por
+        # max_to_start, así que la lista resultante es pequeña)
+        pending_combinations = list(
+            query_items_by_status(state_table, "pending", max_to_start)
+        )
         
         if not pending_combinations:
             logger.info("No hay combinaciones pendientes para procesar")
@@ -483,25 +956,24 @@ def trigger_processing(state_table, state_machine_arn, max_to_start=1):
 
         logger.info(f"Se encontraron {len(pending_combinations)} combinaciones pendientes")
 
-        # Iniciar ejecuciones hasta el límite especificado
-        for combo in pending_combinations:
-            combo_id = combo["id"]
+        # Timestamp único del lote: el combo_id ya hace único el nombre de la
+        # ejecución, no hace falta re-formatear la hora por registro
+        now = datetime.now()
+        now_iso = now.isoformat()
+        now_compact = now.strftime("%Y%m%d%H%M%S")
 
-            # Iniciar ejecución de la máquina de estados
-            execution_name = f"GTFSProcess-{combo_id}-{datetime.now().strftime('%Y%m%d%H%M%S')}"
+        def start_one(combo):
+            """Inicia una ejecución y marca su combinación como en proceso."""
+            combo_id = combo["id"]
+            execution_name = f"GTFSProcess-{combo_id}-{now_compact}"
 
             try:
-                # Verificar que sigue en estado pendiente antes de iniciar
-                response = state_table.get_item(Key={"id": combo_id})
-                if "Item" not in response or response["Item"].get("status") != "pending":
-                    logger.warning(f"La combinación {combo_id} ya no está en estado pendiente")
-                    continue
-
-                # Iniciar ejecución
+                # Iniciar ejecución; la condición del update posterior detecta
+                # carreras sin necesidad de un GetItem de verificación previo
                 execution = step_functions.start_execution(
                     stateMachineArn=state_machine_arn,
                     name=execution_name,
-                    input=json.dumps(combo),
+                    input=_json_dumps(combo),
                 )
 
                 # Actualizar estado en DynamoDB (con condición para seguridad)
@@ -515,23 +987,38 @@ def trigger_processing(state_table, state_machine_arn, max_to_start=1):
                             ":processing": "processing",
                             ":pending": "pending",
                             ":arn": execution["executionArn"],
-                            ":t": datetime.now().isoformat(),
+                            ":t": now_iso,
                         },
                     )
-                    
-                    started += 1
-                    logger.info(f"Ejecución iniciada para {combo_id}: {execution['executionArn']}")
-                    
+                    return True
+
                 except ClientError as e:
                     if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
-                        # El estado ya cambió mientras iniciábamos la ejecución
-                        logger.warning(f"No se pudo actualizar estado para {combo_id}, condición fallida")
-                    else:
-                        raise
+                        # El estado ya cambió: cancelar la ejecución que acabamos de iniciar
+                        logger.warning("La combinación %s ya no está en estado pendiente, cancelando ejecución", combo_id)
+                        try:
+                            step_functions.stop_execution(
+                                executionArn=execution["executionArn"],
+                                cause="La combinación ya no estaba en estado pendiente",
+                            )
+                        except Exception as stop_e:
+                            logger.error("Error al cancelar ejecución para %s: %s", combo_id, str(stop_e))
+                        return False
+                    raise
 
             except Exception as e:
-                logger.error(f"Error al iniciar ejecución para {combo_id}: {str(e)}")
-
+                logger.error("Error al iniciar ejecución para %s: %s", combo_id, str(e))
+                return False
+
+        # Cada arranque es independiente (StartExecution + update condicional),
+        # así que se lanzan en paralelo con concurrencia acotada; el resumen se
+        # loguea una vez en agregado en lugar de una línea por ejecución
+        with ThreadPoolExecutor(
+            max_workers=min(REGISTER_MAX_WORKERS, len(pending_combinations))
+        ) as executor:
+            started = sum(executor.map(start_one, pending_combinations))
+
+        logger.info("Se iniciaron %d de %d ejecuciones pendientes", started, len(pending_combinations))
         return started
 
     except Exception as e:
@@ -543,7 +1030,7 @@ def get_processing_summary(state_table_name, region="eu-west-1"):
     """
     Obtiene un resumen del estado actual de procesamiento.
     """
-    dynamodb = boto3.resource("dynamodb", region_name=region)
+    dynamodb = get_aws_context(region).dynamodb
     
     # Validar tabla
     if not validate_table(dynamodb, state_table_name):
@@ -556,85 +1043,95 @@ def get_processing_summary(state_table_name, region="eu-west-1"):
     state_table = dynamodb.Table(state_table_name)
 
     try:
-        # Función para escanear toda la tabla con paginación
-        def scan_all_items():
-            all_items = []
-            last_evaluated_key = None
-            
-            while True:
-                scan_kwargs = {"Limit": MAX_SCAN_ITEMS}
-                
-                if last_evaluated_key:
-                    scan_kwargs["ExclusiveStartKey"] = last_evaluated_key
-                    
-                response = state_table.scan(**scan_kwargs)
-                all_items.extend(response.get("Items", []))
-                
-                last_evaluated_key = response.get("LastEvaluatedKey")
-                if not last_evaluated_key:
-                    break
-                    
-            return all_items
-        
-        # Escanear toda la tabla con paginación
-        items = scan_all_items()
-        
-        if not items:
-            return {
-                "total": 0,
-                "by_status": {},
-                "timestamp": datetime.now().isoformat(),
-            }
-
-        # Contar combinaciones por estado
-        total = len(items)
-        by_status = {}
+        # Agregar todas las estadísticas en una sola pasada sobre el escaneo
+        # paralelo, sin retener la tabla completa en memoria
+        total = 0
+        by_status = Counter()
         by_enterprise = {}
-        
-        for item in items:
+        recent_heap = []    # Min-heap acotado a 5 con las últimas ejecutadas
+        failed_items = []   # Primeras 5 combinaciones fallidas
+        total_retries = 0
+        items_with_retries = 0
+        max_retries = 0
+
+        # Sin Limit por página: la agregación recorre la tabla entera de todas
+        # formas, así que conviene que cada página llegue al tope de 1 MB de la
+        # API (menos idas y vueltas); la memoria sigue acotada porque los
+        # elementos se consumen en streaming y la proyección los mantiene pequeños
+        for item in parallel_scan(
+            state_table,
+            ProjectionExpression=(
+                "id, #s, #e, P_EMPRESA, P_CONTR, P_VERSION, started_at, retries, execution_arn"
+            ),
+            ExpressionAttributeNames={"#s": "status", "#e": "error"},
+        ):
+            total += 1
+
             # Contar por estado
             status = item.get("status", "unknown")
-            by_status[status] = by_status.get(status, 0) + 1
-            
+            by_status[status] += 1
+
             # Contar por empresa
             enterprise = item.get("P_EMPRESA", "unknown")
-            if enterprise not in by_enterprise:
-                by_enterprise[enterprise] = {
-                    "total": 0, 
-                    "completed": 0, 
-                    "failed": 0, 
-                    "processing": 0, 
+            enterprise_stats = by_enterprise.get(enterprise)
+            if enterprise_stats is None:
+                enterprise_stats = by_enterprise[enterprise] = {
+                    "total": 0,
+                    "completed": 0,
+                    "failed": 0,
+                    "processing": 0,
                     "pending": 0
                 }
-            
-            by_enterprise[enterprise]["total"] += 1
-            if status in by_enterprise[enterprise]:
-                by_enterprise[enterprise][status] += 1
-
-        # Obtener las últimas ejecutadas
-        recent_items = sorted(
-            [item for item in items if item.get("started_at")],
-            key=lambda x: x.get("started_at", ""),
-            reverse=True,
-        )[:5]
-
-        # Obtener las últimas fallidas
-        failed_items = [item for item in items if item.get("status") == "failed"][:5]
-        
+
+            enterprise_stats["total"] += 1
+            if status in enterprise_stats:
+                enterprise_stats[status] += 1
+
+            # Mantener solo las 5 últimas ejecutadas en un min-heap acotado
+            # (total desempata entre timestamps iguales sin comparar dicts)
+            started_at = item.get("started_at")
+            if started_at:
+                entry = (started_at, total, item)
+                if len(recent_heap) < 5:
+                    heapq.heappush(recent_heap, entry)
+                elif entry > recent_heap[0]:
+                    heapq.heappushpop(recent_heap, entry)
+
+            # Primeras fallidas
+            if status == "failed" and len(failed_items) < 5:
+                failed_items.append(item)
+
+            # Estadísticas de reintentos
+            retries = int(item.get("retries") or 0)
+            total_retries += retries
+            if retries > 0:
+                items_with_retries += 1
+            if retries > max_retries:
+                max_retries = retries
+
+        if total == 0:
+            return {
+                "total": 0,
+                "by_status": {},
+                "timestamp": datetime.now().isoformat(),
+            }
+
+        # Obtener las últimas ejecutadas (de más reciente a más antigua)
+        recent_items = [entry[2] for entry in sorted(recent_heap, reverse=True)]
+
         # Calcular porcentaje completado
         completed = by_status.get("completed", 0)
         completion_percentage = (completed / total * 100) if total > 0 else 0
 
-        # Obtener información sobre reintentos
         retry_stats = {
-            "total_retries": sum(int(item.get("retries", 0)) for item in items),
-            "items_with_retries": len([item for item in items if int(item.get("retries", 0)) > 0]),
-            "max_retries": max((int(item.get("retries", 0)) for item in items), default=0)
+            "total_retries": total_retries,
+            "items_with_retries": items_with_retries,
+            "max_retries": max_retries
         }
 
         return {
             "total": total,
-            "by_status": by_status,
+            "by_status": dict(by_status),
             "completion_percentage": round(completion_percentage, 2),
             "by_enterprise": by_enterprise,
             "recent": recent_items,
@@ -655,7 +1152,7 @@ def reset_failed_combinations(state_table_name, region="eu-west-1"):
     """
     Restablece las combinaciones fallidas a estado pendiente.
     """
-    dynamodb = boto3.resource("dynamodb", region_name=region)
+    dynamodb = get_aws_context(region).dynamodb
     
     # Validar tabla
     if not validate_table(dynamodb, state_table_name):
@@ -665,67 +1162,33 @@ def reset_failed_combinations(state_table_name, region="eu-west-1"):
     state_table = dynamodb.Table(state_table_name)
 
     try:
-        # Función para obtener todas las combinaciones fallidas con paginación
-        def get_all_failed_combinations():
-            failed_combinations = []
-            last_evaluated_key = None
-            
-            while True:
-                scan_kwargs = {
-                    "FilterExpression": "#s = :failed",
-                    "ExpressionAttributeNames": {"#s": "status"},
-                    "ExpressionAttributeValues": {":failed": "failed"},
-                    "Limit": MAX_SCAN_ITEMS
-                }
-                
-                if last_evaluated_key:
-                    scan_kwargs["ExclusiveStartKey"] = last_evaluated_key
-                    
-                response = state_table.scan(**scan_kwargs)
-                failed_combinations.extend(response.get("Items", []))
-                
-                last_evaluated_key = response.get("LastEvaluatedKey")
-                if not last_evaluated_key:
-                    break
-                    
-            return failed_combinations
-            
-        # Obtener combinaciones fallidas
-        failed_items = get_all_failed_combinations()
-        
-        if not failed_items:
+        # Restablecer las combinaciones fallidas (obtenidas en streaming vía el
+        # GSI de estado) en lotes de TransactWriteItems, cada una con condición
+        # de que siga en estado fallido
+        now = datetime.now().isoformat()
+        updates = [
+            {
+                "TableName": state_table.name,
+                "Key": {"id": {"S": item["id"]}},
+                "UpdateExpression": "SET #s = :pending, reset_at = :t, retries = if_not_exists(retries, :zero) + :one",
+                "ConditionExpression": "#s = :failed",  # Solo actualizar si sigue en estado fallido
+                "ExpressionAttributeNames": {"#s": "status"},
+                "ExpressionAttributeValues": {
+                    ":pending": {"S": "pending"},
+                    ":failed": {"S": "failed"},
+                    ":t": {"S": now},
+                    ":zero": {"N": "0"},
+                    ":one": {"N": "1"},
+                },
+            }
+            for item in query_items_by_status(state_table, "failed", projection="id")
+        ]
+
+        if not updates:
             logger.info("No hay combinaciones fallidas para restablecer")
             return 0
 
-        # Restablecer cada combinación fallida de forma atómica
-        reset_count = 0
-        for item in failed_items:
-            combo_id = item["id"]
-
-            try:
-                # Actualizar estado en DynamoDB con condición
-                state_table.update_item(
-                    Key={"id": combo_id},
-                    UpdateExpression="SET #s = :pending, reset_at = :t, retries = if_not_exists(retries, :zero) + :one",
-                    ConditionExpression="#s = :failed",  # Solo actualizar si sigue en estado fallido
-                    ExpressionAttributeNames={"#s": "status"},
-                    ExpressionAttributeValues={
-                        ":pending": "pending",
-                        ":failed": "failed",
-                        ":t": datetime.now().isoformat(),
-                        ":zero": 0,
-                        ":one": 1
-                    },
-                )
-
-                reset_count += 1
-                logger.info(f"Combinación {combo_id} restablecida a pendiente")
-
-            except ClientError as e:
-                if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
-                    logger.warning(f"La combinación {combo_id} ya no está en estado fallido")
-                else:
-                    logger.error(f"Error al restablecer combinación {combo_id}: {str(e)}")
+        reset_count = _apply_reset_updates(state_table.meta.client, updates)
 
         logger.info(f"Se restablecieron {reset_count} combinaciones fallidas")
         return reset_count
@@ -803,7 +1266,7 @@ def main():
 
     elif args.operation == "summary":
         summary = get_processing_summary(args.state_table, args.region)
-        print(json.dumps(summary, indent=2))
+        print(_json_dumps(summary, indent=True))
 
     elif args.operation == "reset":
         reset_count = reset_failed_combinations(args.state_table, args.region)
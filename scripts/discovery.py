@@ -3,34 +3,156 @@
 Script para descubrir combinaciones de datos GTFS en S3
 """
 
+import atexit
 import boto3
+import functools
 import json
 import re
 import os
 import argparse
 import logging
-from datetime import datetime
+import logging.handlers
+import queue
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+# orjson es opcional: serializa/parsea ~3-5x más rápido que el json estándar,
+# relevante cuando el resultado crece a decenas de miles de combinaciones
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Configuración de logging: los registros se encolan y un hilo de fondo los
+# vuelca al archivo y a stderr, de modo que los hilos del recorrido solo pagan
+# un Queue.put por línea en lugar de serializar en el lock de los handlers y
+# su I/O de disco/terminal
+_LOG_QUEUE = queue.Queue(-1)
+_LOG_FORMATTER = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+
+_file_handler = logging.FileHandler("discovery.log", delay=True)
+_file_handler.setFormatter(_LOG_FORMATTER)
+_stream_handler = logging.StreamHandler()
+_stream_handler.setFormatter(_LOG_FORMATTER)
+
+# El QueueHandler formatea el registro antes de encolarlo; se le da un
+# formato plano para que el timestamp y el nivel los añada una sola vez el
+# formateador de los handlers del listener
+_queue_handler = logging.handlers.QueueHandler(_LOG_QUEUE)
+_queue_handler.setFormatter(logging.Formatter("%(message)s"))
 
-# Configuración de logging
 logging.basicConfig(
     level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[logging.FileHandler("discovery.log"), logging.StreamHandler()],
+    handlers=[_queue_handler],
 )
+_LOG_LISTENER = logging.handlers.QueueListener(
+    _LOG_QUEUE, _file_handler, _stream_handler
+)
+_LOG_LISTENER.start()
+atexit.register(_LOG_LISTENER.stop)  # Vaciar la cola al terminar el proceso
+
 logger = logging.getLogger(__name__)
 
+# Patrón precompilado que extrae explotación, contrato y versión de una clave
+# S3 en una sola búsqueda
+_COMBO_RE = re.compile(r"explotation=(\d+)/contract=(\d+)/version=([^/]+)/")
+
 # Lista de tipos de datos GTFS requeridos para el procesamiento completo
 REQUIRED_GTFS_TYPES = ["AGENCY", "ROUTES", "TRIPS", "STOPS", "STOP_TIMES"]
 
+# Pertenencia de tipos codificada como máscara de bits: con solo 5 tipos fijos,
+# un entero por combinación sustituye a dos sets y sus add() por elemento
+_TYPE_BIT = {t: 1 << i for i, t in enumerate(REQUIRED_GTFS_TYPES)}
+_ALL_TYPE_BITS = (1 << len(REQUIRED_GTFS_TYPES)) - 1
+
 # El tipo GTFS con menos datos normalmente (usado como punto de partida eficiente)
 SEED_GTFS_TYPE = "AGENCY"  # Generalmente AGENCY tiene menos datos/combinaciones
 
+# Caché del resultado de descubrimiento en el propio bucket: con --use-cache,
+# una ejecución reciente evita repetir el recorrido completo del bucket
+DISCOVERY_CACHE_KEY = "_discovery_cache/combinations.json"
+DISCOVERY_CACHE_TTL = 3600  # Segundos de validez del resultado cacheado
+
+# Cota superior de peticiones S3 concurrentes; dimensiona el pool de
+# conexiones del cliente compartido por los listados paralelos
+VALIDATION_MAX_WORKERS = 64
+
+# Configuración del cliente S3: pool de conexiones a la altura de la
+# concurrencia de validación (el valor por defecto de 10 provoca contención),
+# reintentos adaptativos ante throttling, keep-alive TCP para reutilizar
+# conexiones entre las miles de peticiones pequeñas y timeouts acotados (los
+# valores por defecto son de 60 s)
+BOTO_CONFIG = Config(
+    max_pool_connections=VALIDATION_MAX_WORKERS,
+    retries={"mode": "adaptive", "max_attempts": 5},
+    connect_timeout=5,
+    read_timeout=10,
+    tcp_keepalive=True,
+)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_s3_client(region):
+    """
+    Cliente S3 memoizado por región.
+
+    Construir un cliente resuelve la cadena de credenciales y los modelos del
+    servicio (50-200 ms); memoizarlo permite que llamadas repetidas a
+    discover_gtfs_data reutilicen el mismo cliente y su pool de conexiones.
+    Se crea sobre una sesión propia (como el contexto AWS de registro) en
+    lugar de la sesión global implícita de boto3, que no es segura de
+    construir perezosamente desde varios hilos.
+    """
+    return boto3.Session(region_name=region).client("s3", config=BOTO_CONFIG)
+
+
+def _load_cached_discovery(s3_client, bucket_name):
+    """
+    Devuelve el resultado de descubrimiento cacheado en S3 si sigue vigente.
+
+    Un HeadObject decide la frescura por LastModified antes de descargar nada;
+    cualquier fallo (caché inexistente, sin permisos, JSON corrupto) se trata
+    como caché fría y el descubrimiento sigue su curso normal.
+    """
+    try:
+        head = s3_client.head_object(Bucket=bucket_name, Key=DISCOVERY_CACHE_KEY)
+        age = datetime.now(timezone.utc) - head["LastModified"]
+        if age.total_seconds() > DISCOVERY_CACHE_TTL:
+            return None
+        body = s3_client.get_object(Bucket=bucket_name, Key=DISCOVERY_CACHE_KEY)["Body"].read()
+        return orjson.loads(body) if orjson else json.loads(body)
+    except Exception:
+        return None
+
+
+def _paginate_prefix(s3_client, bucket_name, prefix):
+    """
+    Pagina un listado plano de objetos bajo un prefijo.
+
+    El assert protege la barra final: listar "foo" en lugar de "foo/" puede
+    ser órdenes de magnitud más lento (y devolver prefijos hermanos), y es el
+    tipo de detalle que un refactor pierde sin que ningún test lo note.
+    """
+    assert prefix.endswith("/"), prefix
+    paginator = s3_client.get_paginator("list_objects_v2")
+    # FetchOwner explícito a False: el recorrido solo consume Key, y pedir el
+    # propietario engordaría cada una de las ~1000 entradas por página
+    return paginator.paginate(Bucket=bucket_name, Prefix=prefix, FetchOwner=False)
+
 
 def discover_gtfs_combinations(s3_client, bucket_name):
     """
     Descubre las posibles combinaciones de explotación/contrato/versión
     utilizando AGENCY como punto de partida (habitualmente tiene menos combinaciones).
 
+    En lugar de recorrer la jerarquía nivel a nivel con Delimiter (una llamada
+    por explotación y otra por contrato), se lista GTFS/<semilla>/ completo sin
+    delimitador: cada página amortiza la ida y vuelta entre hasta 1000 claves y
+    las ternas se extraen de las propias claves con una única regex. Ver la
+    clave del archivo principal de la semilla valida además ese tipo de paso,
+    sin HeadObject aparte.
+
     Args:
         s3_client: Cliente de boto3 para S3
         bucket_name: Nombre del bucket de S3
@@ -38,92 +160,42 @@ def discover_gtfs_combinations(s3_client, bucket_name):
     Returns:
         dict: Mapa de combinaciones potenciales con su estado de validación
     """
-    # Patrones para extraer valores
-    explotation_pattern = r"explotation=(\d+)"
-    contract_pattern = r"contract=(\d+)"
-    version_pattern = r"version=([^/]+)"
-
     logger.info(f"Explorando combinaciones utilizando {SEED_GTFS_TYPE} como semilla")
 
     # Estructura para almacenar combinaciones y su estado
     combinations = {}
+    seed_bit = _TYPE_BIT[SEED_GTFS_TYPE]
+    seed_suffix = f"/{SEED_GTFS_TYPE.lower()}.txt"
 
-    # Explorar el tipo GTFS semilla para encontrar combinaciones potenciales
     try:
-        # Listar todas las explotaciones para el tipo semilla
-        prefix = f"GTFS/{SEED_GTFS_TYPE}/"
-        response = s3_client.list_objects_v2(
-            Bucket=bucket_name, Prefix=prefix, Delimiter="/"
-        )
-
-        if "CommonPrefixes" not in response:
-            logger.warning(f"No se encontraron datos para {SEED_GTFS_TYPE}")
-            return combinations
-
-        # Procesar cada explotación encontrada
-        for explotation_prefix in response["CommonPrefixes"]:
-            explotation_path = explotation_prefix["Prefix"]
-            explotation_match = re.search(explotation_pattern, explotation_path)
-
-            if not explotation_match:
-                continue
-
-            explotation = explotation_match.group(1)
-
-            # Listar contratos para esta explotación
-            contract_response = s3_client.list_objects_v2(
-                Bucket=bucket_name, Prefix=explotation_path, Delimiter="/"
-            )
-
-            if "CommonPrefixes" not in contract_response:
-                continue
+        for page in _paginate_prefix(s3_client, bucket_name, f"GTFS/{SEED_GTFS_TYPE}/"):
+            for obj in page.get("Contents", []):
+                key = obj["Key"]
+                match = _COMBO_RE.search(key)
 
-            for contract_prefix in contract_response["CommonPrefixes"]:
-                contract_path = contract_prefix["Prefix"]
-                contract_match = re.search(contract_pattern, contract_path)
-
-                if not contract_match:
-                    continue
-
-                contract = contract_match.group(1)
-
-                # Listar versiones para este contrato
-                version_response = s3_client.list_objects_v2(
-                    Bucket=bucket_name, Prefix=contract_path, Delimiter="/"
-                )
-
-                if "CommonPrefixes" not in version_response:
+                if not match:
                     continue
 
-                for version_prefix in version_response["CommonPrefixes"]:
-                    version_path = version_prefix["Prefix"]
-                    version_match = re.search(version_pattern, version_path)
-
-                    if not version_match:
-                        continue
-
-                    version = version_match.group(1)
-
-                    # Verificar que el archivo principal de AGENCY existe
-                    agency_file = f"{version_path}agency.txt"
-                    try:
-                        s3_client.head_object(Bucket=bucket_name, Key=agency_file)
-
-                        # Agregar esta combinación potencial
-                        combo_key = f"{explotation}_{contract}_{version}"
-                        combinations[combo_key] = {
-                            "P_EMPRESA": explotation,
-                            "P_CONTR": contract,
-                            "P_VERSION": version,
-                            "valid_types": {
-                                SEED_GTFS_TYPE
-                            },  # Marcamos el tipo semilla como válido
-                            "missing_types": set(),
-                        }
-
-                    except Exception:
-                        # No existe el archivo agency.txt, saltamos esta combinación
-                        continue
+                # Clave de deduplicación: la tupla de grupos tal cual, sin
+                # ensamblar (y alocar) un string nuevo por clave listada
+                combo_key = match.groups()
+                combo = combinations.get(combo_key)
+                if combo is None:
+                    explotation, contract, version = combo_key
+                    combo = combinations[combo_key] = {
+                        "P_EMPRESA": explotation,
+                        "P_CONTR": contract,
+                        "P_VERSION": version,
+                        "valid_bits": 0,
+                    }
+
+                    # Línea de progreso periódica en vez de una por combinación
+                    if len(combinations) % 1000 == 0:
+                        logger.info("Descubiertas %d combinaciones hasta ahora", len(combinations))
+
+                # La clave del archivo principal de la semilla ya valida ese tipo
+                if key.endswith(seed_suffix):
+                    combo["valid_bits"] |= seed_bit
 
     except Exception as e:
         logger.error(f"Error explorando combinaciones iniciales: {str(e)}")
@@ -147,30 +219,41 @@ def validate_combinations(s3_client, bucket_name, combinations):
     if not combinations:
         return {}
 
-    # Explorar los tipos GTFS restantes para validar cada combinación
-    for gtfs_type in [t for t in REQUIRED_GTFS_TYPES if t != SEED_GTFS_TYPE]:
-        logger.info(f"Validando archivos para tipo GTFS: {gtfs_type}")
-
-        for combo_key, combo_data in list(combinations.items()):
-            explotation = combo_data["P_EMPRESA"]
-            contract = combo_data["P_CONTR"]
-            version = combo_data["P_VERSION"]
-
-            # Verificar si existe el archivo para este tipo GTFS
-            file_path = f"GTFS/{gtfs_type}/explotation={explotation}/contract={contract}/version={version}/{gtfs_type.lower()}.txt"
-
-            try:
-                s3_client.head_object(Bucket=bucket_name, Key=file_path)
-                # Marcar este tipo como válido para esta combinación
-                combo_data["valid_types"].add(gtfs_type)
-            except Exception:
-                # Archivo no encontrado, marcar como faltante
-                combo_data["missing_types"].add(gtfs_type)
+    def scan_type(gtfs_type):
+        """Lista GTFS/<tipo>/ completo y devuelve las combinaciones con archivo."""
+        found = set()
+        type_suffix = f"/{gtfs_type.lower()}.txt"
+        for page in _paginate_prefix(s3_client, bucket_name, f"GTFS/{gtfs_type}/"):
+            for obj in page.get("Contents", []):
+                key = obj["Key"]
+                if not key.endswith(type_suffix):
+                    continue
+                match = _COMBO_RE.search(key)
+                if match:
+                    found.add(match.groups())
+        return gtfs_type, found
+
+    # Un listado plano por tipo restante, lanzados en paralelo: cada página de
+    # 1000 claves valida cientos de combinaciones de golpe. El listado es
+    # autoritativo (en S3 un prefijo existe si y solo si hay objetos debajo),
+    # así que no hacen falta sondas HeadObject por archivo: un bit sin marcar
+    # tras esta fase significa que el archivo no existe
+    remaining_types = [t for t in REQUIRED_GTFS_TYPES if t != SEED_GTFS_TYPE]
+    with ThreadPoolExecutor(max_workers=len(remaining_types)) as executor:
+        for gtfs_type, found in executor.map(scan_type, remaining_types):
+            type_bit = _TYPE_BIT[gtfs_type]
+            for combo_key in found:
+                combo_data = combinations.get(combo_key)
+                if combo_data:
+                    combo_data["valid_bits"] |= type_bit
 
     # Filtrar solo las combinaciones válidas (que tienen todos los tipos requeridos)
     valid_combinations = {}
+    # Timestamp único del lote de descubrimiento: formatear la hora una vez en
+    # lugar de una por combinación
+    discovery_time = datetime.now().isoformat()
     for combo_key, combo_data in combinations.items():
-        if len(combo_data["valid_types"]) == len(REQUIRED_GTFS_TYPES):
+        if combo_data["valid_bits"] == _ALL_TYPE_BITS:
             # Esta combinación tiene todos los tipos requeridos
             explotation = combo_data["P_EMPRESA"]
             contract = combo_data["P_CONTR"]
@@ -181,28 +264,63 @@ def validate_combinations(s3_client, bucket_name, combinations):
                 "P_CONTR": contract,
                 "P_VERSION": version,
                 "status": "pending",
-                "discovery_time": datetime.now().isoformat(),
-                "gtfs_types": list(combo_data["valid_types"]),
+                "discovery_time": discovery_time,
+                "gtfs_types": list(REQUIRED_GTFS_TYPES),
             }
-            logger.info(
-                f"Combinación válida: E={explotation}, C={contract}, V={version}"
+            logger.debug(
+                "Combinación válida: E=%s, C=%s, V=%s", explotation, contract, version
             )
         else:
-            # Loguear las combinaciones inválidas por falta de archivos
-            missing = combo_data["missing_types"]
+            # Loguear las combinaciones inválidas por falta de archivos,
+            # reconstruyendo los tipos faltantes desde la máscara
+            valid_bits = combo_data["valid_bits"]
+            missing = [t for t in REQUIRED_GTFS_TYPES if not valid_bits & _TYPE_BIT[t]]
             explotation = combo_data["P_EMPRESA"]
             contract = combo_data["P_CONTR"]
             version = combo_data["P_VERSION"]
             logger.warning(
-                f"Combinación incompleta (faltan archivos): E={explotation}, C={contract}, V={version}. "
-                f"Archivos faltantes: {', '.join(missing)}"
+                "Combinación incompleta (faltan archivos): E=%s, C=%s, V=%s. Archivos faltantes: %s",
+                explotation, contract, version, ", ".join(missing),
             )
 
     return valid_combinations
 
 
+def _write_combinations_file(path, combinations_list, bucket_name, region):
+    """
+    Escribe el archivo de combinaciones emitiendo cada entrada por separado.
+
+    Serializar combinación a combinación evita construir el documento completo
+    como un único string en memoria y permite a un consumidor (o un tail -f)
+    empezar a leer el archivo mientras se escribe.
+    """
+    # Codificador por entrada: orjson si está disponible (emite bytes, de ahí
+    # el decode), con el json estándar como respaldo
+    if orjson:
+        dumps = lambda obj: orjson.dumps(obj).decode()
+    else:
+        dumps = json.dumps
+
+    with open(path, "w") as f:
+        f.write('{\n  "combinations": [\n')
+        for index, combo in enumerate(combinations_list):
+            if index:
+                f.write(",\n")
+            f.write("    ")
+            f.write(dumps(combo))
+        f.write("\n  ],\n")
+        f.write(f'  "total": {len(combinations_list)},\n')
+        f.write(f'  "timestamp": {json.dumps(datetime.now().isoformat())},\n')
+        f.write(f'  "bucket": {json.dumps(bucket_name)},\n')
+        f.write(f'  "region": {json.dumps(region)}\n')
+        f.write("}\n")
+
+
 def discover_gtfs_data(
-    bucket_name, region="eu-west-1", output_file="batch_processing/combinations.json"
+    bucket_name,
+    region="eu-west-1",
+    output_file="batch_processing/combinations.json",
+    use_cache=False,
 ):
     """
     Descubre todas las combinaciones válidas de explotación, contrato y versión en S3,
@@ -212,6 +330,8 @@ def discover_gtfs_data(
         bucket_name: Nombre del bucket de S3 a escanear
         region: Región AWS donde está el bucket
         output_file: Archivo de salida para guardar las combinaciones
+        use_cache: Reutilizar el resultado cacheado en S3 si tiene menos de
+            DISCOVERY_CACHE_TTL segundos, evitando repetir el recorrido
 
     Returns:
         Lista de combinaciones encontradas
@@ -220,7 +340,21 @@ def discover_gtfs_data(
         f"Iniciando descubrimiento optimizado en bucket: {bucket_name}, región: {region}"
     )
 
-    s3_client = boto3.client("s3", region_name=region)
+    s3_client = _get_s3_client(region)
+
+    # Reutilizar un descubrimiento reciente si se pide y el bucket tiene uno
+    if use_cache:
+        cached = _load_cached_discovery(s3_client, bucket_name)
+        if cached is not None:
+            combinations_list = cached.get("combinations", [])
+            os.makedirs(os.path.dirname(output_file), exist_ok=True)
+            with open(output_file, "w") as f:
+                json.dump(cached, f, indent=2)
+            logger.info(
+                "Reutilizando descubrimiento cacheado en S3: %d combinaciones",
+                len(combinations_list),
+            )
+            return combinations_list
 
     try:
         # Paso 1: Descubrir combinaciones potenciales usando el tipo semilla
@@ -241,16 +375,16 @@ def discover_gtfs_data(
         # Crear directorio de salida si no existe
         os.makedirs(os.path.dirname(output_file), exist_ok=True)
 
-        # Guardar resultado en archivo JSON
-        with open(output_file, "w") as f:
-            result = {
-                "combinations": combinations_list,
-                "total": len(combinations_list),
-                "timestamp": datetime.now().isoformat(),
-                "bucket": bucket_name,
-                "region": region,
-            }
-            json.dump(result, f, indent=2)
+        # Guardar resultado en archivo JSON, combinación a combinación
+        _write_combinations_file(output_file, combinations_list, bucket_name, region)
+
+        # Publicar el resultado como caché para futuras ejecuciones con
+        # --use-cache (mejor esfuerzo: un fallo aquí no invalida el resultado).
+        # upload_file transmite desde disco sin cargar el documento en memoria
+        try:
+            s3_client.upload_file(output_file, bucket_name, DISCOVERY_CACHE_KEY)
+        except Exception as cache_e:
+            logger.warning("No se pudo publicar la caché de descubrimiento: %s", str(cache_e))
 
         logger.info(
             f"Descubrimiento completado: {len(combinations_list)} combinaciones válidas"
@@ -280,5 +414,11 @@ if __name__ == "__main__":
         help="Archivo de salida JSON",
     )
 
+    parser.add_argument(
+        "--use-cache",
+        action="store_true",
+        help="Reutilizar el resultado de descubrimiento cacheado en S3 si es reciente",
+    )
+
     args = parser.parse_args()
-    discover_gtfs_data(args.bucket, args.region, args.output)
+    discover_gtfs_data(args.bucket, args.region, args.output, args.use_cache)
@@ -6,17 +6,27 @@ y análisis. Implementa técnicas de procesamiento por lotes y optimización de
 para manejar grandes volúmenes de datos en AWS Glue.
 """
 
+import os
 import sys
 import gc
 import io
-import uuid
 import boto3
 import psutil
 import logging
 import functools
+import numpy as np
 import pandas as pd
 from awsglue.utils import getResolvedOptions
 
+# pyarrow (presente en el entorno de Glue) acelera el parseo/serializado CSV
+# con kernels multihilo; si no está disponible se usa la ruta pandas clásica
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError:
+    pa = None
+    pacsv = None
+
 
 # Configuración básica
 s3_client = boto3.client("s3")
@@ -27,6 +37,23 @@ logging.basicConfig(
 )
 logger = logging.getLogger()
 
+# Diagnóstico de memoria bajo demanda: activo solo con MACRO_DEBUG=1 para no
+# pagar gc.collect() y syscalls de psutil en cada merge del camino caliente
+_DEBUG = os.getenv("MACRO_DEBUG") == "1"
+
+# Diagnósticos de merge por lote: solo con MACRO_VERBOSE=1 (o MACRO_DEBUG=1)
+_VERBOSE = _DEBUG or os.getenv("MACRO_VERBOSE") == "1"
+
+# El colector generacional se fuerza solo cada K lotes, no en cada iteración
+GC_EVERY_BATCHES = 8
+
+# Handle del proceso reutilizado por las métricas de memoria (psutil.Process
+# implica una syscall en cada construcción)
+_PROC = psutil.Process()
+
+# Equivalencia entre los tipos del esquema macro y dtypes de pandas
+_PANDAS_DTYPES = {"string": "object", "double": "float64", "bigint": "Int64"}
+
 
 def log_memory_usage(label: str) -> float:
     """Registra el uso de memoria actual y lo devuelve en MB.
@@ -35,10 +62,13 @@ def log_memory_usage(label: str) -> float:
         label: Etiqueta descriptiva para el log de memoria.
 
     Returns:
-        Uso de memoria en MB.
+        Uso de memoria en MB (0.0 si el diagnóstico está desactivado).
     """
-    gc.collect()
-    memory_mb = psutil.Process().memory_info().rss / (1024 * 1024)
+    if not _DEBUG:
+        return 0.0
+    # Sin gc.collect(): la métrica observa, no debe alterar el heap; quien
+    # necesite una recolección la invoca explícitamente
+    memory_mb = _PROC.memory_info().rss / (1024 * 1024)
     print(f"MEMORIA [{label}]: {memory_mb:.2f} MB")
     return memory_mb
 
@@ -50,8 +80,11 @@ def memory_logger(func):
         func: Función a decorar.
 
     Returns:
-        Función decorada con registro de memoria.
+        Función decorada con registro de memoria (sin cambios si el
+        diagnóstico está desactivado).
     """
+    if not _DEBUG:
+        return func
 
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
@@ -86,12 +119,16 @@ def merge_with_memory(*args, **kwargs):
     return result
 
 
-pd.merge = merge_with_memory
+if _DEBUG:
+    pd.merge = merge_with_memory
 
 
 def read_csv_s3(bucket, key, **kwargs):
     """Lee un archivo CSV desde S3.
 
+    Usa el lector multihilo de pyarrow cuando está disponible y no se piden
+    opciones específicas de pandas; en caso contrario delega en pd.read_csv.
+
     Args:
         bucket: Nombre del bucket S3.
         key: Ruta del archivo dentro del bucket.
@@ -100,23 +137,163 @@ def read_csv_s3(bucket, key, **kwargs):
     Returns:
         DataFrame con el contenido del CSV.
     """
-    kwargs["low_memory"] = True
     response = s3_client.get_object(Bucket=bucket, Key=key)
-    return pd.read_csv(io.BytesIO(response["Body"].read()), encoding="utf8", **kwargs)
+    buf = response["Body"].read()
+    if pacsv is not None and set(kwargs) <= {"dtype"}:
+        # Parseo SIMD multihilo sin copia intermedia bytes→StringIO→parser.
+        # Los dtypes con equivalente Arrow se aplican durante el parseo; los
+        # propios de pandas (category, enteros anulables) tras la lectura
+        dtypes = kwargs.get("dtype") or {}
+        arrow_types = {
+            str: pa.string(),
+            "string": pa.string(),
+            "float32": pa.float32(),
+            "float64": pa.float64(),
+        }
+        column_types = {
+            col: arrow_types[dt] for col, dt in dtypes.items() if dt in arrow_types
+        }
+        table = pacsv.read_csv(
+            pa.BufferReader(buf),
+            read_options=pacsv.ReadOptions(use_threads=True),
+            convert_options=pacsv.ConvertOptions(column_types=column_types),
+        )
+        df = table.to_pandas()
+        pandas_dtypes = {
+            col: dt
+            for col, dt in dtypes.items()
+            if dt not in arrow_types and col in df.columns
+        }
+        if pandas_dtypes:
+            df = df.astype(pandas_dtypes)
+        return df
+    kwargs["low_memory"] = True
+    return pd.read_csv(io.BytesIO(buf), encoding="utf8", **kwargs)
 
 
-def write_csv_s3(df, bucket, key):
-    """Guarda un DataFrame como CSV en S3.
+def _batch_csv_bytes(df, include_header):
+    """Serializa un lote a bytes CSV, con pyarrow cuando el esquema lo permite.
 
     Args:
-        df: DataFrame a guardar.
-        bucket: Nombre del bucket S3.
-        key: Ruta de destino dentro del bucket.
+        df: DataFrame del lote, ya en el orden canónico de columnas.
+        include_header: Si se incluye la línea de encabezado (solo la
+            primera parte del archivo final la lleva).
+
+    Returns:
+        Bytes CSV listos para anexar al multipart upload.
     """
+    if pacsv is not None:
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            with io.BytesIO() as out_buf:
+                pacsv.write_csv(
+                    table, out_buf, pacsv.WriteOptions(include_header=include_header)
+                )
+                return out_buf.getvalue()
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            pass
     with io.StringIO() as csv_buffer:
-        df.to_csv(csv_buffer, index=False)
-        csv_buffer.seek(0)
-        s3_client.put_object(Bucket=bucket, Key=key, Body=csv_buffer.getvalue())
+        df.to_csv(csv_buffer, index=False, header=include_header)
+        return csv_buffer.getvalue().encode("utf-8")
+
+
+# Tamaño mínimo de parte exigido por S3 (salvo la última parte)
+MULTIPART_MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+class S3MultipartWriter:
+    """Escritor incremental a S3 basado en Multipart Upload.
+
+    Acumula bytes en un buffer interno y los sube como partes cuando superan
+    el tamaño mínimo exigido por S3 (5 MiB, salvo la última parte). Permite
+    construir un objeto grande por anexado sin releer lo ya escrito.
+    """
+
+    def __init__(self, bucket, key):
+        self.bucket = bucket
+        self.key = key
+        self.upload_id = None
+        self.parts = []
+        self.buffer = bytearray()
+
+    def start(self):
+        """Inicia el multipart upload y devuelve el propio escritor."""
+        response = s3_client.create_multipart_upload(Bucket=self.bucket, Key=self.key)
+        self.upload_id = response["UploadId"]
+        return self
+
+    def write(self, data):
+        """Añade bytes al buffer y sube una parte al alcanzar el mínimo.
+
+        Args:
+            data: Bytes a anexar al objeto final.
+        """
+        self.buffer.extend(data)
+        if len(self.buffer) >= MULTIPART_MIN_PART_SIZE:
+            self._flush_part()
+
+    def _flush_part(self):
+        part_number = len(self.parts) + 1
+        response = s3_client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            PartNumber=part_number,
+            UploadId=self.upload_id,
+            Body=bytes(self.buffer),
+        )
+        self.parts.append({"PartNumber": part_number, "ETag": response["ETag"]})
+        self.buffer.clear()
+
+    def close(self):
+        """Sube la parte pendiente y completa el multipart upload."""
+        # La última parte puede ser menor al mínimo; también cubre el caso
+        # de un objeto que cabe entero en una sola parte
+        if self.buffer or not self.parts:
+            self._flush_part()
+        s3_client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={"Parts": self.parts},
+        )
+
+    def abort(self):
+        """Aborta el upload para no dejar partes huérfanas facturables."""
+        s3_client.abort_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+        )
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+            return False
+        self.close()
+        return False
+
+
+def _drop_duplicates_by_codes(df, cols):
+    """Elimina filas duplicadas comparando códigos enteros de categoría.
+
+    Equivalente a df[cols].drop_duplicates() pero factorizando cada columna
+    una sola vez y deduplicando sobre los códigos enteros con np.unique, en
+    lugar de hashear cada string fila a fila.
+
+    Args:
+        df: DataFrame de origen.
+        cols: Columnas que definen la clave de deduplicación.
+
+    Returns:
+        DataFrame con las columnas indicadas y sin filas duplicadas,
+        conservando el orden de primera aparición.
+    """
+    codes = np.column_stack(
+        [df[c].astype("category").cat.codes.to_numpy() for c in cols]
+    )
+    _, idx = np.unique(codes, axis=0, return_index=True)
+    return df.iloc[np.sort(idx)][cols]
 
 
 def normalize_dataframe_ids(df, columns):
@@ -131,11 +308,66 @@ def normalize_dataframe_ids(df, columns):
     """
     for col in columns:
         if col in df.columns:
-            # Convertir a string, eliminar espacios y normalizar
-            df[col] = df[col].astype(str).str.strip()
+            # Convertir a string, rellenar nulos y eliminar espacios en una
+            # sola pasada; los lotes heredan valores ya limpios
+            df[col] = df[col].astype("string").fillna("").str.strip()
     return df
 
 
+@functools.lru_cache(maxsize=None)
+def safe_color(x):
+    """Normaliza un código de color individual (camino lento de referencia).
+
+    Se conserva como implementación de referencia para depuración; el camino
+    caliente usa la versión vectorizada normalize_colors. Los resultados se
+    memoizan: las paletas reales tienen pocas decenas de colores distintos,
+    así que cada valor se calcula una sola vez.
+
+    Args:
+        x: Valor de color a normalizar.
+
+    Returns:
+        String con color normalizado en formato hexadecimal.
+    """
+    if pd.isna(x) or str(x).lower() == "nan" or not x:
+        return "#000000"  # Color negro por defecto
+    try:
+        color = str(x).lower().strip()
+        if not color.startswith("#"):
+            color = "#" + color
+        if len(color) == 4:
+            color = "#" + "".join(c + c for c in color[1:])
+        if len(color) != 7:
+            return "#000000"
+        if not all(c in "0123456789abcdef#" for c in color):
+            return "#000000"
+        return color
+    except:
+        return "#000000"
+
+
+def normalize_colors(colors):
+    """Normaliza una Serie de colores de ruta a formato hexadecimal #rrggbb.
+
+    Versión vectorizada de safe_color: toda la Serie se procesa con los
+    kernels de cadena de pandas en lugar de un callable Python por fila.
+
+    Args:
+        colors: Serie con los colores originales de route_color.
+
+    Returns:
+        Serie de strings con colores normalizados (#000000 si inválido).
+    """
+    c = colors.astype("string").str.lower().str.strip()
+    c = c.where(~c.isna() & (c != "nan") & (c != ""), "000000")
+    c = c.where(c.str.startswith("#"), "#" + c)
+    # Expandir formato corto #abc a #aabbcc
+    short = c.str.match(r"^#[0-9a-f]{3}$", na=False)
+    c = c.mask(short, "#" + c.str[1] * 2 + c.str[2] * 2 + c.str[3] * 2)
+    valid = c.str.match(r"^#[0-9a-f]{6}$", na=False)
+    return c.where(valid, "#000000").astype(str)
+
+
 def log_diagnostico_merge(df_left, df_right, col_join, label=""):
     """Realiza diagnóstico detallado antes de un merge para identificar problemas.
 
@@ -149,24 +381,26 @@ def log_diagnostico_merge(df_left, df_right, col_join, label=""):
         Diccionario con estadísticas de diagnóstico o None si no aplica.
     """
     if col_join in df_left.columns and col_join in df_right.columns:
-        values_left = set(df_left[col_join].unique())
-        values_right = set(df_right[col_join].unique())
+        # Operaciones de conjunto sobre pd.Index (implementadas en C) en lugar
+        # de materializar sets de Python con la columna completa
+        left_idx = pd.Index(df_left[col_join].unique())
+        right_idx = pd.Index(df_right[col_join].unique())
 
-        common = values_left.intersection(values_right)
-        only_left = values_left - values_right
-        only_right = values_right - values_left
+        common = left_idx.intersection(right_idx)
+        only_left = left_idx.difference(right_idx)
+        only_right = right_idx.difference(left_idx)
 
         print(f"DIAGNÓSTICO MERGE {label}:")
-        print(f"- Valores únicos en izquierdo: {len(values_left)}")
-        print(f"- Valores únicos en derecho: {len(values_right)}")
+        print(f"- Valores únicos en izquierdo: {len(left_idx)}")
+        print(f"- Valores únicos en derecho: {len(right_idx)}")
         print(f"- Valores comunes: {len(common)}")
         print(f"- Solo en izquierdo: {len(only_left)} valores")
         print(f"- Solo en derecho: {len(only_right)} valores")
 
         if len(common) == 0:
             print("⚠️ ALERTA: No hay valores comunes para el merge!")
-            print(f"Muestra de valores izquierdos: {list(values_left)[:5]}")
-            print(f"Muestra de valores derechos: {list(values_right)[:5]}")
+            print(f"Muestra de valores izquierdos: {list(left_idx[:5])}")
+            print(f"Muestra de valores derechos: {list(right_idx[:5])}")
 
         return {"common": common, "only_left": only_left, "only_right": only_right}
     return None
@@ -181,13 +415,14 @@ def create_df_macro_stream(
     P_CONTR=None,
     P_VERSION=None,
     batch_size=5,
-    execution_id=None,
     bucket=None,
+    final_path=None,
 ):
-    """Crea un dataframe macro con rutas, viajes y formas procesando por lotes.
+    """Crea el archivo macro con rutas, viajes y formas procesando por lotes.
 
-    Procesa la información por lotes para optimizar el uso de memoria, escribiendo
-    resultados temporales a S3 y realizando validaciones para garantizar integridad.
+    Procesa la información por lotes para optimizar el uso de memoria y anexa
+    cada lote directamente como parte de un multipart upload sobre la clave
+    final, sin round-trip por archivos temporales.
 
     Args:
         trips: DataFrame con información de viajes.
@@ -197,11 +432,11 @@ def create_df_macro_stream(
         P_CONTR: Identificador del contrato.
         P_VERSION: Versión de los datos.
         batch_size: Número de rutas a procesar por lote.
-        execution_id: Identificador de ejecución para nombramiento de archivos.
         bucket: Nombre del bucket S3 para almacenamiento.
+        final_path: Clave S3 del archivo final a generar.
 
     Returns:
-        Diccionario con información de procesamiento y archivos temporales.
+        Diccionario con información de procesamiento del archivo generado.
     """
     print("Creando dataframe macro con escritura directa a S3")
     print(
@@ -249,23 +484,21 @@ def create_df_macro_stream(
                 f"- routes[route_id]: {routes['route_id'].dtype}, ejemplo: '{routes['route_id'].iloc[0]}'"
             )
 
-            # Verificar si hay diferencias por padding con ceros (común en IDs de transporte)
-            trips_padded = trips.copy()
-            routes_padded = routes.copy()
-
-            # Intentar con padding de 3 dígitos
-            trips_padded["route_id_padded"] = trips_padded["route_id"].str.zfill(3)
-            routes_padded["route_id_padded"] = routes_padded["route_id"].str.zfill(3)
-
-            diagnostico_padded = log_diagnostico_merge(
-                trips_padded, routes_padded, "route_id_padded", "CON-PADDING"
+            # Verificar si hay diferencias por padding con ceros (común en IDs
+            # de transporte); la hipótesis se prueba sobre las Series con
+            # pd.Index, sin copiar las tablas completas
+            t_pad = trips["route_id"].str.zfill(3)
+            r_pad = routes["route_id"].str.zfill(3)
+            common_padded = pd.Index(t_pad.unique()).intersection(
+                pd.Index(r_pad.unique())
             )
+            print(f"DIAGNÓSTICO CON-PADDING: {len(common_padded)} valores comunes")
 
-            if diagnostico_padded and len(diagnostico_padded["common"]) > 0:
+            if len(common_padded) > 0:
                 print("✓ Se encontraron coincidencias usando padding con ceros!")
                 # Usar las versiones con padding
-                trips["route_id"] = trips["route_id"].str.zfill(3)
-                routes["route_id"] = routes["route_id"].str.zfill(3)
+                trips["route_id"] = t_pad
+                routes["route_id"] = r_pad
                 print("Datos normalizados con padding de ceros.")
 
     # Normalización de tipos para garantizar compatibilidad en las operaciones de merge
@@ -283,13 +516,25 @@ def create_df_macro_stream(
     if "shape_id" in trips.columns:
         print(f"INFO - Tipo de datos shape_id en trips: {trips['shape_id'].dtype}")
 
-    unique_routes = trips["route_id"].unique()
-    temp_files = []
-    total_rows = 0
+    # Índices hash construidos una sola vez antes del bucle: las búsquedas
+    # por ruta o shape pasan a ser O(lote) en lugar de reescaneos completos
+    routes_idx = routes[~routes["route_id"].duplicated(keep="first")].set_index(
+        "route_id"
+    )
+    shapes_idx = None
+    shape_index_set = set()
+    if shapes is not None and not shapes.empty:
+        shapes_idx = shapes.set_index("shape_id")
+        shape_index_set = set(shapes_idx.index.unique())
 
-    # Usar el execution_id provisto o generar uno nuevo
-    batch_uuid = execution_id or str(uuid.uuid4())
-    base_temp_path = f"GTFS_TEMP/MACRO/{batch_uuid}/explotation={P_EMPRESA}/contract={P_CONTR}/version={P_VERSION}"
+    # Ordenar trips por route_id una sola vez: cada lote se extrae como un
+    # slice contiguo vía searchsorted en lugar de reescanear toda la tabla
+    trips_sorted = trips.sort_values("route_id", kind="stable", ignore_index=True)
+    unique_routes = trips_sorted["route_id"].unique()
+    route_starts = trips_sorted["route_id"].searchsorted(unique_routes, side="left")
+    route_ends = trips_sorted["route_id"].searchsorted(unique_routes, side="right")
+
+    total_rows = 0
 
     # Definir columnas esperadas y sus tipos
     macro_columns = {
@@ -319,403 +564,242 @@ def create_df_macro_stream(
         "continuous_drop_off": "string",
     }
 
-    # Procesamiento por lotes para reducir consumo de memoria
-    for i in range(0, len(unique_routes), batch_size):
-        batch_routes = unique_routes[i : i + batch_size]
-        print(
-            f"Procesando lote {i//batch_size + 1} de rutas para df_macro ({len(batch_routes)} rutas)"
-        )
-        print(f"Route IDs en el lote actual: {batch_routes}")
-        print(
-            f"¿Cuántas de estas rutas están en routes? {sum(routes['route_id'].isin(batch_routes))}"
-        )
-
-        # Filtrar viajes de las rutas actuales
-        batch_trips = trips[trips["route_id"].isin(batch_routes)].copy()
-
-        if batch_trips.empty:
-            print(f"No hay viajes para las rutas: {batch_routes}")
-            continue
-
-        # Solo necesitamos las rutas de este lote
-        batch_routes_df = routes[routes["route_id"].isin(batch_routes)].copy()
-
-        # Verificación detallada del merge
-        print(f"Detalles de batch_routes_df: {len(batch_routes_df)} filas")
-        if len(batch_routes_df) == 0:
-            print("⚠️ ALERTA: No se encontraron rutas en routes para este lote!")
-            print(f"Batch routes: {batch_routes}")
-            print(f"Routes disponibles: {routes['route_id'].unique()[:10]}")
-
-            # Usar left join para identificar problemas específicos
-            temp_merge = batch_trips[["route_id"]].merge(
-                routes[["route_id", "route_short_name"]], on="route_id", how="left"
+    # Multipart upload abierto sobre la clave final: cada lote se anexa como
+    # una parte del CSV definitivo; si algo falla se aborta el upload para no
+    # dejar partes huérfanas
+    writer = S3MultipartWriter(bucket, final_path).start()
+    write_header = True
+    try:
+        # Procesamiento por lotes para reducir consumo de memoria
+        for i in range(0, len(unique_routes), batch_size):
+            batch_routes = unique_routes[i : i + batch_size]
+            print(
+                f"Procesando lote {i//batch_size + 1} de rutas para df_macro ({len(batch_routes)} rutas)"
             )
-            missing_info = temp_merge[temp_merge["route_short_name"].isna()]
-            if not missing_info.empty:
-                print(f"Rutas sin coincidencia: {missing_info['route_id'].unique()}")
-
-            # Intentar continuar con las rutas disponibles
-            continue
-
-        # Normalización para asegurar compatibilidad
-        batch_routes_df["route_id"] = (
-            batch_routes_df["route_id"].astype(str).str.strip()
-        )
-        batch_trips["route_id"] = batch_trips["route_id"].astype(str).str.strip()
-        batch_trips["trip_id"] = batch_trips["trip_id"].astype(str).str.strip()
-
-        if "shape_id" in batch_trips.columns:
-            batch_trips["shape_id"] = (
-                batch_trips["shape_id"].fillna("").astype(str).str.strip()
+            print(f"Route IDs en el lote actual: {batch_routes}")
+            print(
+                f"¿Cuántas de estas rutas están en routes? {len(routes_idx.index.intersection(batch_routes))}"
             )
 
-        # Procesamiento de colores
-        def safe_color(x):
-            """Normaliza códigos de color y aplica validaciones de seguridad.
-
-            Args:
-                x: Valor de color a normalizar.
-
-            Returns:
-                String con color normalizado en formato hexadecimal.
-            """
-            if pd.isna(x) or str(x).lower() == "nan" or not x:
-                return "#000000"  # Color negro por defecto
-            try:
-                color = str(x).lower().strip()
-                if not color.startswith("#"):
-                    color = "#" + color
-                if len(color) == 4:
-                    color = "#" + "".join(c + c for c in color[1:])
-                if len(color) != 7:
-                    return "#000000"
-                if not all(c in "0123456789abcdef#" for c in color):
-                    return "#000000"
-                return color
-            except:
-                return "#000000"
-
-        batch_routes_df["Final_Color"] = batch_routes_df["route_color"].apply(
-            safe_color
-        )
-        batch_routes_df["Final_Color"] = batch_routes_df["Final_Color"].astype(str)
-
-        # Diagnóstico detallado antes del merge
-        log_diagnostico_merge(
-            batch_trips, batch_routes_df, "route_id", "BATCH-TRIPS-ROUTES"
-        )
-
-        # Primer merge - trips con routes
-        df_macro_part = batch_trips.merge(batch_routes_df, on="route_id", how="inner")
-        print(f"Merge trips-routes para lote: {len(df_macro_part)} filas")
-
-        if df_macro_part.empty:
-            print(
-                f"El merge trips-routes dejó un resultado vacío para las rutas: {batch_routes}"
+            # Filtrar viajes de las rutas actuales: slice contiguo sin copia
+            last = min(i + batch_size, len(unique_routes)) - 1
+            batch_trips = trips_sorted.iloc[route_starts[i] : route_ends[last]]
+
+            if batch_trips.empty:
+                print(f"No hay viajes para las rutas: {batch_routes}")
+                continue
+
+            # Solo necesitamos las rutas de este lote: lookup O(lote) sobre el índice
+            batch_routes_df = routes_idx.reindex(batch_routes).dropna(how="all")
+
+            # Verificación detallada del merge
+            print(f"Detalles de batch_routes_df: {len(batch_routes_df)} filas")
+            if len(batch_routes_df) == 0:
+                print("⚠️ ALERTA: No se encontraron rutas en routes para este lote!")
+                print(f"Batch routes: {batch_routes}")
+                print(f"Routes disponibles: {routes['route_id'].unique()[:10]}")
+
+                # Usar left join para identificar problemas específicos
+                temp_merge = batch_trips[["route_id"]].merge(
+                    routes[["route_id", "route_short_name"]],
+                    on="route_id",
+                    how="left",
+                    sort=False,
+                    copy=False,
+                )
+                missing_info = temp_merge[temp_merge["route_short_name"].isna()]
+                if not missing_info.empty:
+                    print(f"Rutas sin coincidencia: {missing_info['route_id'].unique()}")
+
+                # Intentar continuar con las rutas disponibles
+                continue
+
+            # Procesamiento de colores (vectorizado sobre la Serie completa)
+            batch_routes_df["Final_Color"] = normalize_colors(
+                batch_routes_df["route_color"]
             )
-            continue
 
-        df_macro_part["route_short_name"] = df_macro_part["route_short_name"].astype(
-            str
-        )
+            # Diagnóstico detallado antes del merge (solo en modo verboso)
+            if _VERBOSE:
+                log_diagnostico_merge(
+                    batch_trips,
+                    batch_routes_df.reset_index(),
+                    "route_id",
+                    "BATCH-TRIPS-ROUTES",
+                )
+
+            # Primer merge - trips con routes (join hash contra el índice por
+            # ruta); validate documenta la cardinalidad viaje→ruta y sort/copy
+            # evitan la ordenación y la copia de bloques redundantes
+            df_macro_part = batch_trips.merge(
+                batch_routes_df,
+                left_on="route_id",
+                right_index=True,
+                how="inner",
+                sort=False,
+                copy=False,
+                validate="many_to_one",
+            )
+            print(f"Merge trips-routes para lote: {len(df_macro_part)} filas")
 
-        # Procesamiento de shapes
-        if (
-            shapes is not None
-            and not shapes.empty
-            and "shape_id" in df_macro_part.columns
-        ):
-            try:
-                # Obtener solo las shapes necesarias para este lote
-                shape_ids = set(df_macro_part["shape_id"].dropna().unique())
-                if shape_ids:
-                    batch_shapes = shapes[shapes["shape_id"].isin(shape_ids)].copy()
-                    batch_shapes["shape_id"] = (
-                        batch_shapes["shape_id"].fillna("").astype(str).str.strip()
-                    )
+            if df_macro_part.empty:
+                print(
+                    f"El merge trips-routes dejó un resultado vacío para las rutas: {batch_routes}"
+                )
+                continue
 
-                    # Verificar si hay shapes_ids comunes
-                    log_diagnostico_merge(
-                        df_macro_part, batch_shapes, "shape_id", "DF_MACRO-SHAPES"
-                    )
-                    common_shapes = set(df_macro_part["shape_id"]) & set(
-                        batch_shapes["shape_id"]
-                    )
+            df_macro_part["route_short_name"] = df_macro_part["route_short_name"].astype(
+                str
+            )
 
-                    if common_shapes:
-                        # PRIMERO: Unir con shapes
-                        df_macro_part = pd.merge(
-                            df_macro_part, batch_shapes, on="shape_id", how="inner"
-                        )
-                        print(f"Merge con shapes para lote: {len(df_macro_part)} filas")
-
-                        # SEGUNDO: Filtrar columnas y eliminar duplicados
-                        df_macro_filtered = df_macro_part[
-                            [
-                                "shape_id",
-                                "Final_Color",
-                                "route_short_name",
-                                "trip_headsign",
-                            ]
-                        ].drop_duplicates()
-
-                        # TERCERO: Volver a unir con shapes
-                        log_diagnostico_merge(
-                            df_macro_filtered,
-                            batch_shapes,
-                            "shape_id",
-                            "DF_MACRO_FILTERED-SHAPES",
-                        )
-                        df_macro_part = df_macro_filtered.merge(
-                            batch_shapes, on="shape_id", how="inner"
-                        )
+            # Procesamiento de shapes
+            if shapes_idx is not None and "shape_id" in df_macro_part.columns:
+                try:
+                    # Obtener solo las shapes necesarias para este lote
+                    shape_ids = set(df_macro_part["shape_id"].dropna().unique())
+                    if shape_ids:
+                        # Verificar si hay shapes_ids comunes contra el índice hoisted
+                        common_shapes = shape_ids & shape_index_set
                         print(
-                            f"Merge final con shapes para lote: {len(df_macro_part)} filas"
+                            f"Shapes del lote: {len(shape_ids)} ids, {len(common_shapes)} con geometría"
                         )
+
+                        if common_shapes:
+                            # Deduplicar las claves antes de tocar la geometría:
+                            # evita materializar el producto trips × shapes
+                            # intermedio que luego se descartaba
+                            df_macro_filtered = _drop_duplicates_by_codes(
+                                df_macro_part,
+                                [
+                                    "shape_id",
+                                    "Final_Color",
+                                    "route_short_name",
+                                    "trip_headsign",
+                                ],
+                            )
+
+                            # Un único join con shapes sobre las claves únicas
+                            df_macro_part = df_macro_filtered.merge(
+                                shapes_idx,
+                                left_on="shape_id",
+                                right_index=True,
+                                how="inner",
+                                sort=False,
+                                copy=False,
+                            )
+                            print(
+                                f"Merge final con shapes para lote: {len(df_macro_part)} filas"
+                            )
+                        else:
+                            print(
+                                f"⚠️ No hay shapes_ids comunes para las rutas: {batch_routes}"
+                            )
+                            # Mantener solo columnas relevantes sin shapes
+                            df_macro_part = _drop_duplicates_by_codes(
+                                df_macro_part,
+                                [
+                                    "Final_Color",
+                                    "route_short_name",
+                                    "trip_headsign",
+                                    "route_id",
+                                    "trip_id",
+                                    "service_id",
+                                    "shape_id",
+                                ],
+                            )
+                            print(
+                                f"Continuando solo con datos básicos: {len(df_macro_part)} filas"
+                            )
                     else:
-                        print(
-                            f"⚠️ No hay shapes_ids comunes para las rutas: {batch_routes}"
-                        )
-                        # Mantener solo columnas relevantes sin shapes
-                        df_macro_part = df_macro_part[
-                            [
-                                "Final_Color",
-                                "route_short_name",
-                                "trip_headsign",
-                                "route_id",
-                                "trip_id",
-                                "service_id",
-                                "shape_id",
-                            ]
-                        ].drop_duplicates()
-                        print(
-                            f"Continuando solo con datos básicos: {len(df_macro_part)} filas"
-                        )
-                else:
-                    print(f"No hay shape_ids válidos para las rutas: {batch_routes}")
-            except Exception as e:
-                logging.error(f"Error procesando shapes para lote: {str(e)}")
-                print(f"⚠️ Error en procesamiento de shapes: {str(e)}")
-                # Intentar continuar solo con datos básicos
-                df_macro_part = df_macro_part[
-                    [
-                        "Final_Color",
-                        "route_short_name",
-                        "trip_headsign",
-                        "route_id",
-                        "trip_id",
-                        "service_id",
-                        "shape_id",
-                    ]
-                ].drop_duplicates()
-                print(f"Continuando solo con datos básicos: {len(df_macro_part)} filas")
-
-        # Normalizar columnas
-        if (
-            "Final_Color" in df_macro_part.columns
-            and "final_color" not in df_macro_part.columns
-        ):
-            df_macro_part.rename(columns={"Final_Color": "final_color"}, inplace=True)
-
-        # Asegurar que todas las columnas esperadas existan
-        for col, dtype in macro_columns.items():
-            if col not in df_macro_part.columns:
-                df_macro_part[col] = None
-
-                if dtype == "string":
-                    df_macro_part[col] = df_macro_part[col].astype("object")
-                elif dtype == "double":
-                    df_macro_part[col] = pd.to_numeric(
-                        df_macro_part[col], errors="coerce"
+                        print(f"No hay shape_ids válidos para las rutas: {batch_routes}")
+                except Exception as e:
+                    logging.error(f"Error procesando shapes para lote: {str(e)}")
+                    print(f"⚠️ Error en procesamiento de shapes: {str(e)}")
+                    # Intentar continuar solo con datos básicos
+                    df_macro_part = _drop_duplicates_by_codes(
+                        df_macro_part,
+                        [
+                            "Final_Color",
+                            "route_short_name",
+                            "trip_headsign",
+                            "route_id",
+                            "trip_id",
+                            "service_id",
+                            "shape_id",
+                        ],
                     )
-                elif dtype == "bigint":
-                    df_macro_part[col] = pd.to_numeric(
-                        df_macro_part[col], errors="coerce"
-                    ).astype("Int64")
-
-        # Detección y eliminación de columnas duplicadas
-        if df_macro_part.columns.duplicated().any():
-            print(
-                f"ALERTA: Columnas duplicadas detectadas: {df_macro_part.columns[df_macro_part.columns.duplicated()].tolist()}"
-            )
-            df_macro_part = df_macro_part.loc[
-                :, ~df_macro_part.columns.duplicated(keep="first")
-            ]
-
-        # Guardar lote procesado a S3
-        temp_file_path = f"{base_temp_path}/batch_{i//batch_size + 1}.csv"
-        write_csv_s3(df_macro_part, bucket, temp_file_path)
-        temp_files.append(temp_file_path)
-        total_rows += len(df_macro_part)
-
-        # Liberar memoria
-        del batch_trips, batch_routes_df, df_macro_part
-        gc.collect()
+                    print(f"Continuando solo con datos básicos: {len(df_macro_part)} filas")
+
+            # Normalizar columnas
+            if (
+                "Final_Color" in df_macro_part.columns
+                and "final_color" not in df_macro_part.columns
+            ):
+                df_macro_part.rename(columns={"Final_Color": "final_color"}, inplace=True)
+
+            # Asegurar que todas las columnas esperadas existan: se añaden todas
+            # de una vez (el índice ya no aporta información tras los joins) para
+            # no fragmentar el BlockManager insertando columna a columna
+            missing = {
+                col: _PANDAS_DTYPES[dtype]
+                for col, dtype in macro_columns.items()
+                if col not in df_macro_part.columns
+            }
+            if missing:
+                df_macro_part = df_macro_part.reset_index(drop=True)
+                df_macro_part = pd.concat(
+                    [
+                        df_macro_part,
+                        pd.DataFrame(
+                            {
+                                col: pd.Series(index=df_macro_part.index, dtype=dt)
+                                for col, dt in missing.items()
+                            }
+                        ),
+                    ],
+                    axis=1,
+                )
+
+            # Detección y eliminación de columnas duplicadas
+            if df_macro_part.columns.duplicated().any():
+                print(
+                    f"ALERTA: Columnas duplicadas detectadas: {df_macro_part.columns[df_macro_part.columns.duplicated()].tolist()}"
+                )
+                df_macro_part = df_macro_part.loc[
+                    :, ~df_macro_part.columns.duplicated(keep="first")
+                ]
+
+            # Escribir siempre en el orden canónico del esquema: la fase de
+            # combinado puede confiar en columns_info sin renormalizar columnas
+            df_macro_part = df_macro_part.reindex(columns=list(macro_columns))
+
+            # Anexar el lote como parte del archivo final
+            writer.write(_batch_csv_bytes(df_macro_part, include_header=write_header))
+            write_header = False
+            total_rows += len(df_macro_part)
+
+            # Liberar memoria; el colector completo solo se fuerza cada K lotes
+            del batch_trips, batch_routes_df, df_macro_part
+            if (i // batch_size + 1) % GC_EVERY_BATCHES == 0:
+                gc.collect()
+        if write_header:
+            # Ningún lote produjo datos: dejar al menos el encabezado canónico
+            writer.write((",".join(macro_columns) + "\n").encode("utf-8"))
+        writer.close()
+    except BaseException:
+        writer.abort()
+        raise
 
     print(f"Procesados {total_rows} filas en total para df_macro")
-    print(f"Archivos temporales creados: {len(temp_files)}")
+    print(f"Archivo final generado en: {final_path}")
 
     return {
-        "temp_files": temp_files,
         "total_rows": total_rows,
         "columns_info": macro_columns,
-        "base_temp_path": base_temp_path,
+        "final_path": final_path,
     }
 
 
-def combine_temp_files(temp_info, final_path, entity_type, bucket):
-    """Combina archivos temporales en un solo archivo final con estructura coherente.
-
-    Args:
-        temp_info: Diccionario con información de archivos temporales.
-        final_path: Ruta de destino para el archivo final.
-        entity_type: Tipo de entidad ('MACRO_STOPS' u otro).
-        bucket: Nombre del bucket S3.
-    """
-    temp_files = temp_info["temp_files"]
-
-    print(f"Combinando {len(temp_files)} archivos temporales en {final_path}")
-
-    # Verificar si hay archivos temporales
-    if not temp_files:
-        print(f"ALERTA: No hay archivos temporales para combinar en {final_path}")
-        return
-
-    # Preservar información de columnas para uso posterior
-    columns_info = temp_info.get("columns_info", {})
-
-    # Fase 1: Determinar el esquema unificado de columnas
-    all_columns = set()
-    for temp_file in temp_files:
-        try:
-            content = (
-                s3_client.get_object(Bucket=bucket, Key=temp_file)["Body"]
-                .read()
-                .decode("utf-8")
-            )
-            df_sample = pd.read_csv(io.StringIO(content), nrows=1)
-            all_columns.update(df_sample.columns)
-            del df_sample
-        except Exception as e:
-            logging.error(f"Error al analizar esquema de {temp_file}: {str(e)}")
-
-    # Fase 2: Establecer orden de columnas consistente
-    if columns_info:
-        ordered_columns = [col for col in columns_info.keys() if col in all_columns]
-        # Incluir columnas adicionales encontradas manteniendo consistencia
-        ordered_columns.extend(
-            [col for col in all_columns if col not in ordered_columns]
-        )
-    else:
-        ordered_columns = sorted(all_columns)
-
-    print(
-        f"Esquema unificado: {len(ordered_columns)} columnas: {ordered_columns[:5]}..."
-    )
-
-    # Fase 3: Integración secuencial de archivos temporales
-    total_rows_processed = 0
-
-    for i, temp_file in enumerate(temp_files):
-        try:
-            print(f"Integrando archivo {i+1}/{len(temp_files)}: {temp_file}")
-            content = (
-                s3_client.get_object(Bucket=bucket, Key=temp_file)["Body"]
-                .read()
-                .decode("utf-8")
-            )
-
-            # Garantizar consistencia de esquema en cada archivo
-            df = pd.read_csv(io.StringIO(content))
-
-            # Normalización de esquema para consistencia
-            for col in ordered_columns:
-                if col not in df.columns:
-                    df[col] = None
-
-            # Aplicar orden unificado de columnas
-            df = df[ordered_columns]
-
-            # Escritura incremental manteniendo integridad estructural
-            if i == 0:
-                # Primer archivo establece estructura con encabezados
-                write_csv_s3(df, bucket, final_path)
-            else:
-                # Archivos subsecuentes mantienen estructura sin duplicar encabezados
-                with io.StringIO() as csv_buffer:
-                    df.to_csv(csv_buffer, index=False, header=False)
-                    csv_buffer.seek(0)
-                    append_content = csv_buffer.getvalue()
-
-                    # Evitar adición de contenido vacío
-                    if append_content.strip():
-                        existing_content = (
-                            s3_client.get_object(Bucket=bucket, Key=final_path)["Body"]
-                            .read()
-                            .decode("utf-8")
-                        )
-                        s3_client.put_object(
-                            Bucket=bucket,
-                            Key=final_path,
-                            Body=existing_content + append_content,
-                        )
-
-            total_rows_processed += len(df)
-            print(
-                f"Progreso: {len(df)} filas añadidas. Acumulado: {total_rows_processed} filas"
-            )
-
-            # Optimización de memoria
-            del df
-            gc.collect()
-
-        except Exception as e:
-            logging.error(f"Error en procesamiento de {temp_file}: {str(e)}")
-
-    # Fase 4: Verificación de integridad estructural final
-    try:
-        final_content = (
-            s3_client.get_object(Bucket=bucket, Key=final_path)["Body"]
-            .read()
-            .decode("utf-8")
-        )
-        first_line = final_content.split("\n", 1)[0]
-
-        # Validar integridad de encabezados
-        if not any(col in first_line for col in ordered_columns[:3]):
-            logging.warning(
-                "Detectada posible inconsistencia estructural en el archivo final"
-            )
-
-            # Restauración de integridad estructural
-            header_line = ",".join(ordered_columns) + "\n"
-            data_lines = "\n".join(final_content.splitlines()[1:])
-            s3_client.put_object(
-                Bucket=bucket, Key=final_path, Body=header_line + data_lines
-            )
-            logging.info(
-                "Estructura normalizada para compatibilidad con servicios de análisis"
-            )
-    except Exception as e:
-        logging.error(f"Error en validación estructural final: {str(e)}")
-
-    print("Limpiando archivos temporales")
-    base_temp_path = temp_info["base_temp_path"]
-
-    try:
-        response = s3_client.list_objects_v2(Bucket=bucket, Prefix=base_temp_path)
-        if "Contents" in response:
-            objects_to_delete = [{"Key": obj["Key"]} for obj in response["Contents"]]
-            s3_client.delete_objects(
-                Bucket=bucket, Delete={"Objects": objects_to_delete, "Quiet": True}
-            )
-    except Exception as e:
-        logging.warning(f"Error limpiando archivos temporales: {str(e)}")
-
-    print(f"Archivo final guardado en: {final_path}")
-
-
 def main():
 
     # Obtener parámetros usando el bronze_bucket existente en lugar de duplicar
@@ -742,20 +826,42 @@ def main():
     log_memory_usage("Inicio de MacroGenerator")
 
     try:
-        # Leer archivos preprocesados
-        trips = read_csv_s3(bucket, f"{temp_dir}/trips.csv")
-        routes = read_csv_s3(bucket, f"{temp_dir}/routes.csv")
+        # Leer archivos preprocesados con dtypes compactos: categorías para
+        # columnas de baja cardinalidad que no participan en joins y
+        # numéricos de 32 bits para la tabla de shapes (la más voluminosa)
+        trips = read_csv_s3(
+            bucket,
+            f"{temp_dir}/trips.csv",
+            dtype={"service_id": "category", "block_id": "category"},
+        )
+        routes = read_csv_s3(
+            bucket,
+            f"{temp_dir}/routes.csv",
+            dtype={"agency_id": "category", "route_type": "category"},
+        )
 
         # Intentar leer shapes si existen
         try:
-            shapes = read_csv_s3(bucket, f"{temp_dir}/shapes.csv")
+            shapes = read_csv_s3(
+                bucket,
+                f"{temp_dir}/shapes.csv",
+                dtype={
+                    "shape_pt_lat": "float32",
+                    "shape_pt_lon": "float32",
+                    "shape_pt_sequence": "Int32",
+                    "shape_dist_traveled": "float32",
+                },
+            )
         except Exception as e:
             logger.warning(
                 f"No se encontró archivo shapes.csv en el directorio temporal: {str(e)}"
             )
             shapes = None
 
-        # Procesar macros con la misma función del código original
+        # Establecer ruta de salida idéntica a la original
+        output_path_macro = f"MAPS/MACRO/explotation={P_EMPRESA}/contract={P_CONTR}/version={P_VERSION}/{P_VERSION}_macro"
+
+        # Procesar macros escribiendo cada lote directamente al archivo final
         macro_info = create_df_macro_stream(
             trips,
             routes,
@@ -764,16 +870,10 @@ def main():
             P_CONTR,
             P_VERSION,
             batch_size=5,
-            execution_id=execution_id,
             bucket=bucket,  # Pasar el bucket explícitamente
+            final_path=output_path_macro,
         )
 
-        # Establecer ruta de salida idéntica a la original
-        output_path_macro = f"MAPS/MACRO/explotation={P_EMPRESA}/contract={P_CONTR}/version={P_VERSION}/{P_VERSION}_macro"
-
-        # Combinar archivos usando la función exacta del original
-        combine_temp_files(macro_info, output_path_macro, "MACRO", bucket)
-
         log_memory_usage("Fin de MacroGenerator")
 
         print(
@@ -9,10 +9,13 @@ import sys
 import gc
 import io
 import uuid
+import collections
 import boto3
 import logging
+import tempfile
 import functools
 import pandas as pd
+from boto3.s3.transfer import TransferConfig
 from awsglue.utils import getResolvedOptions
 
 
@@ -25,6 +28,14 @@ except ImportError:
     subprocess.check_call([sys.executable, "-m", "pip", "install", "psutil"])
     import psutil
 
+# pyarrow es opcional: si está disponible se usa su parser CSV multihilo
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError:
+    pa = None
+    pacsv = None
+
 # Configuración básica
 s3_client = boto3.client("s3")
 s3 = boto3.resource("s3")
@@ -34,6 +45,14 @@ logging.basicConfig(
 )
 logger = logging.getLogger()
 
+# Configuración de transferencia: sube en paralelo partes de 8 MB cuando
+# el objeto supera ese umbral
+_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=8,
+)
+
 
 def log_memory_usage(label: str) -> float:
     """Registra el uso de memoria actual y lo devuelve en MB.
@@ -117,7 +136,24 @@ def read_csv_s3(bucket, key, **kwargs):
         kwargs["dtype"] = dtype_params
 
     response = s3_client.get_object(Bucket=bucket, Key=key)
-    return pd.read_csv(io.BytesIO(response["Body"].read()), encoding="utf8", **kwargs)
+
+    # Ruta rápida con pyarrow: parser multihilo con los IDs forzados a
+    # string para no perder ceros a la izquierda. Solo aplica cuando no
+    # hay argumentos extra que el lector de Arrow no entiende.
+    extra_kwargs = set(kwargs) - {"low_memory", "dtype"}
+    if pacsv is not None and not extra_kwargs:
+        table = pacsv.read_csv(
+            response["Body"],
+            read_options=pacsv.ReadOptions(use_threads=True),
+            convert_options=pacsv.ConvertOptions(
+                column_types={col: pa.string() for col in dtype_params}
+            ),
+        )
+        return table.to_pandas()
+
+    # El cuerpo de la respuesta se pasa directamente al parser para no
+    # duplicar el archivo completo en memoria dentro de un BytesIO
+    return pd.read_csv(response["Body"], encoding="utf8", **kwargs)
 
 
 def write_csv_s3(df, bucket, key):
@@ -128,10 +164,83 @@ def write_csv_s3(df, bucket, key):
         bucket: Nombre del bucket S3.
         key: Ruta de destino dentro del bucket.
     """
-    with io.StringIO() as csv_buffer:
-        df.to_csv(csv_buffer, index=False)
-        csv_buffer.seek(0)
-        s3_client.put_object(Bucket=bucket, Key=key, Body=csv_buffer.getvalue())
+    # El CSV se materializa en un buffer que se derrama a disco pasados
+    # 32 MB, y se sube con multipart paralelo en lugar de un put_object
+    # monolítico
+    with tempfile.SpooledTemporaryFile(max_size=32 * 1024 * 1024) as tmp:
+        df.to_csv(tmp, index=False, mode="wb", encoding="utf-8")
+        tmp.seek(0)
+        s3_client.upload_fileobj(tmp, bucket, key, Config=_TRANSFER_CONFIG)
+
+
+# Tamaño mínimo de parte exigido por S3 (salvo la última parte)
+MULTIPART_MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+class S3MultipartWriter:
+    """Escritor incremental a S3 basado en Multipart Upload.
+
+    Acumula bytes en un buffer interno y los sube como partes cuando superan
+    el tamaño mínimo exigido por S3 (5 MiB, salvo la última parte). Permite
+    construir un objeto grande por anexado sin releer lo ya escrito.
+    """
+
+    def __init__(self, bucket, key, acl=None):
+        self.bucket = bucket
+        self.key = key
+        self.acl = acl
+        self.upload_id = None
+        self.parts = []
+        self.buffer = bytearray()
+
+    def __enter__(self):
+        create_kwargs = {"Bucket": self.bucket, "Key": self.key}
+        if self.acl:
+            create_kwargs["ACL"] = self.acl
+        response = s3_client.create_multipart_upload(**create_kwargs)
+        self.upload_id = response["UploadId"]
+        return self
+
+    def write(self, data):
+        """Añade bytes al buffer y sube una parte al alcanzar el mínimo.
+
+        Args:
+            data: Bytes a anexar al objeto final.
+        """
+        self.buffer.extend(data)
+        if len(self.buffer) >= MULTIPART_MIN_PART_SIZE:
+            self._flush_part()
+
+    def _flush_part(self):
+        part_number = len(self.parts) + 1
+        response = s3_client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            PartNumber=part_number,
+            UploadId=self.upload_id,
+            Body=bytes(self.buffer),
+        )
+        self.parts.append({"PartNumber": part_number, "ETag": response["ETag"]})
+        self.buffer.clear()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            # Abortar para no dejar partes huérfanas facturables en S3
+            s3_client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+            )
+            return False
+        # La última parte puede ser menor al mínimo; también cubre el caso
+        # de un objeto que cabe entero en una sola parte
+        if self.buffer or not self.parts:
+            self._flush_part()
+        s3_client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={"Parts": self.parts},
+        )
+        return False
 
 
 def normalize_dataframe_ids(df, columns):
@@ -146,12 +255,9 @@ def normalize_dataframe_ids(df, columns):
     """
     for col in columns:
         if col in df.columns:
-            # Asegurar que la columna sea de tipo object
-            if df[col].dtype != "object":
-                df[col] = df[col].astype("object")
-
-            # Usar map con lambda para preservar formato exacto
-            df[col] = df[col].map(lambda x: str(x).strip())
+            # Pipeline vectorizado: una pasada en C en lugar de un map
+            # con lambda por elemento
+            df[col] = df[col].astype("string").fillna("").str.strip()
     return df
 
 
@@ -168,26 +274,31 @@ def log_diagnostico_merge(df_left, df_right, col_join, label=""):
         Diccionario con estadísticas de diagnóstico o None si no aplica.
     """
     if col_join in df_left.columns and col_join in df_right.columns:
-        values_left = set(df_left[col_join].unique())
-        values_right = set(df_right[col_join].unique())
+        # Operaciones de Index basadas en hash: evitan materializar sets
+        # de Python con un objeto por elemento
+        values_left = pd.Index(df_left[col_join].unique())
+        values_right = pd.Index(df_right[col_join].unique())
 
         common = values_left.intersection(values_right)
-        only_left = values_left - values_right
-        only_right = values_right - values_left
 
         print(f"DIAGNÓSTICO MERGE {label}:")
         print(f"- Valores únicos en izquierdo: {len(values_left)}")
         print(f"- Valores únicos en derecho: {len(values_right)}")
         print(f"- Valores comunes: {len(common)}")
-        print(f"- Solo en izquierdo: {len(only_left)} valores")
-        print(f"- Solo en derecho: {len(only_right)} valores")
+        print(f"- Solo en izquierdo: {len(values_left) - len(common)} valores")
+        print(f"- Solo en derecho: {len(values_right) - len(common)} valores")
 
         if len(common) == 0:
+            # Las diferencias solo se materializan cuando hay que mostrarlas
             print("⚠️ ALERTA: No hay valores comunes para el merge!")
-            print(f"Muestra de valores izquierdos: {list(values_left)[:5]}")
-            print(f"Muestra de valores derechos: {list(values_right)[:5]}")
-
-        return {"common": common, "only_left": only_left, "only_right": only_right}
+            print(f"Muestra de valores izquierdos: {values_left[:5].tolist()}")
+            print(f"Muestra de valores derechos: {values_right[:5].tolist()}")
+
+        return {
+            "common": common,
+            "only_left": values_left.difference(common),
+            "only_right": values_right.difference(common),
+        }
     return None
 
 
@@ -234,10 +345,19 @@ def create_df_macro_stops_stream(
     print(f"- routes[route_id] únicos: {len(routes['route_id'].unique())}")
     print(f"- trips[route_id] únicos: {len(trips['route_id'].unique())}")
 
-    # Verificar compatibilidad inicial entre trips y routes
-    diagnostico_trips_routes = log_diagnostico_merge(
-        trips, routes, "route_id", "TRIPS-ROUTES"
-    )
+    # Sonda barata de compatibilidad: un isin vectorizado sobre trips.
+    # Si la mayoría de los route_id ya casa con routes, el diagnóstico
+    # exhaustivo no aporta nada y se omite
+    routes_ids = pd.Index(routes["route_id"].unique())
+    match_ratio = trips["route_id"].isin(routes_ids).mean()
+    print(f"- Fracción de trips con route_id conocido: {match_ratio:.3f}")
+
+    diagnostico_trips_routes = None
+    if match_ratio <= 0.5:
+        # Verificar compatibilidad inicial entre trips y routes
+        diagnostico_trips_routes = log_diagnostico_merge(
+            trips, routes, "route_id", "TRIPS-ROUTES"
+        )
 
     # Detección y corrección de incompatibilidades entre IDs
     if diagnostico_trips_routes and len(diagnostico_trips_routes["common"]) == 0:
@@ -307,12 +427,21 @@ def create_df_macro_stops_stream(
     temp_files = []
     total_rows = 0
 
+    # Índices hash construidos una sola vez: el filtrado por lote pasa de
+    # escanear las tablas completas con isin a búsquedas sobre índices
+    # ordenados, que además entregan cortes contiguos en memoria
+    trips_by_route = trips.set_index("route_id").sort_index()
+    stop_times_by_trip = stop_times.set_index("trip_id").sort_index()
+    routes_by_id = routes.set_index("route_id").sort_index()
+    stops_by_id = stops.set_index("stop_id").sort_index()
+
     # Usar el execution_id provisto o generar uno nuevo
     batch_uuid = execution_id or str(uuid.uuid4())
     base_temp_path = f"GTFS_TEMP/MACRO_STOPS/{batch_uuid}/explotation={P_EMPRESA}/contract={P_CONTR}/version={P_VERSION}"
 
-    # Diccionario para almacenar todas las líneas que pasan por cada parada
-    all_stop_lines = {}
+    # Conjunto de líneas que pasan por cada parada; los sets deduplican
+    # sobre la marcha sin necesidad de una pasada final
+    all_stop_lines = collections.defaultdict(set)
 
     # Definición de todas las columnas esperadas con sus tipos de datos
     macro_stops_columns = {
@@ -376,37 +505,51 @@ def create_df_macro_stops_stream(
         )
         print(f"Route IDs en el lote actual: {batch_routes}")
         print(
-            f"¿Cuántas de estas rutas están en routes? {sum(routes['route_id'].isin(batch_routes))}"
+            f"¿Cuántas de estas rutas están en routes? {len(routes_by_id.index.intersection(batch_routes))}"
         )
 
-        # Filtrar viajes de las rutas actuales
-        batch_trips = trips[trips["route_id"].isin(batch_routes)].copy()
+        # Filtrar viajes de las rutas actuales mediante el índice
+        batch_trips = trips_by_route.loc[
+            trips_by_route.index.intersection(batch_routes)
+        ].reset_index()
 
         if batch_trips.empty:
             print(f"No hay viajes para las rutas: {batch_routes}")
             continue
 
-        # Obtener horarios relevantes para estos viajes
-        trip_ids = set(batch_trips["trip_id"])
-        batch_stop_times = stop_times[stop_times["trip_id"].isin(trip_ids)].copy()
+        # Obtener horarios relevantes para estos viajes mediante el índice
+        trip_ids = stop_times_by_trip.index.intersection(
+            batch_trips["trip_id"].unique()
+        )
+        batch_stop_times = stop_times_by_trip.loc[trip_ids]
 
         if batch_stop_times.empty:
             print(f"No hay horarios para los viajes de las rutas: {batch_routes}")
             continue
 
-        # 1. Unir viajes con horarios
-        log_diagnostico_merge(
-            batch_trips, batch_stop_times, "trip_id", "BATCH-TRIPS-STOP_TIMES"
+        # 1. Unir viajes con horarios contra el índice ya construido;
+        # validate documenta la cardinalidad esperada y detecta viajes
+        # duplicados en origen
+        batch_df = batch_trips.merge(
+            batch_stop_times,
+            left_on="trip_id",
+            right_index=True,
+            how="inner",
+            validate="one_to_many",
         )
-        batch_df = batch_trips.merge(batch_stop_times, on="trip_id", how="inner")
         print(f"Merge trips-stop_times para lote: {len(batch_df)} filas")
 
         if batch_df.empty:
             continue
 
         # 2. Incorporar información de paradas
-        log_diagnostico_merge(batch_df, stops, "stop_id", "BATCH-DF-STOPS")
-        batch_df = batch_df.merge(stops, on="stop_id", how="inner")
+        batch_df = batch_df.merge(
+            stops_by_id,
+            left_on="stop_id",
+            right_index=True,
+            how="inner",
+            validate="many_to_one",
+        )
         print(f"Merge con stops para lote: {len(batch_df)} filas")
 
         if batch_df.empty:
@@ -414,7 +557,9 @@ def create_df_macro_stops_stream(
             continue
 
         # 3. Incorporar información de rutas
-        batch_routes_df = routes[routes["route_id"].isin(batch_routes)].copy()
+        batch_routes_df = routes_by_id.loc[
+            routes_by_id.index.intersection(batch_routes)
+        ].copy()
 
         # Verificación detallada del merge
         print(f"Detalles de batch_routes_df: {len(batch_routes_df)} filas")
@@ -429,14 +574,8 @@ def create_df_macro_stops_stream(
             if not missing_info.empty:
                 print(f"Rutas sin coincidencia: {missing_info['route_id'].unique()}")
 
-        # Normalización para asegurar compatibilidad
-        batch_routes_df["route_id"] = (
-            batch_routes_df["route_id"].astype(str).str.strip()
-        )
-        batch_df["route_id"] = batch_df["route_id"].astype(str).str.strip()
-
-        # Diagnóstico detallado antes del merge
-        log_diagnostico_merge(batch_df, batch_routes_df, "route_id", "BATCH-DF-ROUTES")
+        # Los route_id ya llegan normalizados por normalize_dataframe_ids,
+        # por lo que no hace falta repetir astype/strip en cada lote
 
         # Procesamiento de colores para representación visual
         def safe_color(x):
@@ -470,7 +609,13 @@ def create_df_macro_stops_stream(
             )
 
             # Usar left join para diagnosticar problemas
-            batch_df = batch_df.merge(batch_routes_df, on="route_id", how="left")
+            batch_df = batch_df.merge(
+                batch_routes_df,
+                left_on="route_id",
+                right_index=True,
+                how="left",
+                validate="many_to_one",
+            )
 
             # Verificar si se perdieron datos en el merge
             missing_routes_data = batch_df[batch_df["route_short_name"].isna()]
@@ -506,17 +651,13 @@ def create_df_macro_stops_stream(
                 str
             )  # Identificador compuesto
 
-            # Recolección de líneas por parada para reportes y visualizaciones
-            for stop in batch_df["stop_id"].unique():
-                lines = (
-                    batch_df[batch_df["stop_id"] == stop]["route_short_name"]
-                    .unique()
-                    .tolist()
-                )
-                if stop in all_stop_lines:
-                    all_stop_lines[stop].extend(lines)
-                else:
-                    all_stop_lines[stop] = lines
+            # Recolección de líneas por parada para reportes y visualizaciones:
+            # un único groupby en lugar de un escaneo completo por parada
+            batch_lines = batch_df.groupby("stop_id", sort=False)[
+                "route_short_name"
+            ].unique()
+            for stop, lines in batch_lines.items():
+                all_stop_lines[stop].update(lines)
 
             # Placeholder - se rellenará en la fase de combinación final
             batch_df["lines_by_stop"] = ""
@@ -571,10 +712,6 @@ def create_df_macro_stops_stream(
             del batch_df
         gc.collect()
 
-    # Eliminar duplicados de líneas por parada
-    for stop in all_stop_lines:
-        all_stop_lines[stop] = list(set(all_stop_lines[stop]))
-
     print(f"Procesados {total_rows} filas en total para df_macro_stops")
     print(f"Archivos temporales creados: {len(temp_files)}")
 
@@ -622,72 +759,52 @@ def combine_temp_files(temp_info, final_path, entity_type, bucket):
         all_stop_lines = temp_info["stop_lines"]
         stop_lines_mapping = {}
 
-        # Crear mapeo final de líneas por parada
+        # Crear mapeo final de líneas por parada (ya vienen deduplicadas)
         for stop, lines in all_stop_lines.items():
-            stop_lines_mapping[stop] = ", ".join(sorted(set(lines)))
-
-        # Procesar cada archivo temporal
-        for i, temp_file in enumerate(temp_files):
-            try:
-                content = (
-                    s3_client.get_object(Bucket=bucket, Key=temp_file)["Body"]
-                    .read()
-                    .decode("utf-8")
-                )
-
-                df = pd.read_csv(io.StringIO(content), dtype=id_dtypes)
-
-                df["lines_by_stop"] = df["stop_id"].map(
-                    lambda x: stop_lines_mapping.get(x, "")
-                )
-
-                if df.columns.duplicated().any():
-                    print(
-                        f"ALERTA: Columnas duplicadas en archivo {temp_file}: {df.columns[df.columns.duplicated()].tolist()}"
+            stop_lines_mapping[stop] = ", ".join(sorted(lines))
+
+        # Procesar cada archivo temporal anexándolo como parte de un único
+        # multipart upload (el ACL se fija una sola vez al crear el upload)
+        write_header = True
+        with S3MultipartWriter(
+            bucket, final_path, acl="bucket-owner-full-control"
+        ) as writer:
+            for i, temp_file in enumerate(temp_files):
+                try:
+                    response = s3_client.get_object(Bucket=bucket, Key=temp_file)
+                    df = pd.read_csv(response["Body"], dtype=id_dtypes)
+
+                    df["lines_by_stop"] = df["stop_id"].map(
+                        lambda x: stop_lines_mapping.get(x, "")
                     )
-                    df = df.loc[:, ~df.columns.duplicated(keep="first")]
-                    print(f"Columnas después de eliminar duplicados: {len(df.columns)}")
 
-                if i == 0:
-                    write_csv_s3(df, bucket, final_path)
-                else:
-                    # Añadir datos sin encabezados para continuar el archivo
-                    with io.StringIO() as csv_buffer:
-                        df.to_csv(csv_buffer, index=False, header=False)
-                        csv_buffer.seek(0)
-                        append_content = csv_buffer.getvalue()
-
-                        # Obtener el contenido existente
-                        existing_content = (
-                            s3_client.get_object(Bucket=bucket, Key=final_path)["Body"]
-                            .read()
-                            .decode("utf-8")
+                    if df.columns.duplicated().any():
+                        print(
+                            f"ALERTA: Columnas duplicadas en archivo {temp_file}: {df.columns[df.columns.duplicated()].tolist()}"
                         )
-
-                        # Combinar preservando la estructura
-                        s3_client.put_object(
-                            Bucket=bucket,
-                            Key=final_path,
-                            Body=existing_content + append_content,
-                            ACL="bucket-owner-full-control",
+                        df = df.loc[:, ~df.columns.duplicated(keep="first")]
+                        print(
+                            f"Columnas después de eliminar duplicados: {len(df.columns)}"
                         )
 
-                del df
-                gc.collect()
+                    # El encabezado solo se escribe en la primera parte
+                    with io.StringIO() as csv_buffer:
+                        df.to_csv(csv_buffer, index=False, header=write_header)
+                        writer.write(csv_buffer.getvalue().encode("utf-8"))
+                    write_header = False
 
-            except Exception as e:
-                logging.error(f"Error procesando archivo {temp_file}: {str(e)}")
+                    del df
+                    gc.collect()
+
+                except Exception as e:
+                    logging.error(f"Error procesando archivo {temp_file}: {str(e)}")
     else:
         # Fase 1: Determinar el esquema unificado de columnas
         all_columns = set()
         for temp_file in temp_files:
             try:
-                content = (
-                    s3_client.get_object(Bucket=bucket, Key=temp_file)["Body"]
-                    .read()
-                    .decode("utf-8")
-                )
-                df_sample = pd.read_csv(io.StringIO(content), nrows=1)
+                response = s3_client.get_object(Bucket=bucket, Key=temp_file)
+                df_sample = pd.read_csv(response["Body"], nrows=1)
                 all_columns.update(df_sample.columns)
                 del df_sample
             except Exception as e:
@@ -706,61 +823,41 @@ def combine_temp_files(temp_info, final_path, entity_type, bucket):
             f"Esquema unificado: {len(ordered_columns)} columnas: {ordered_columns[:5]}..."
         )
 
-        # Fase 3: Integración secuencial de archivos temporales
+        # Fase 3: Integración en streaming mediante un único multipart upload
         total_rows_processed = 0
+        write_header = True
 
-        for i, temp_file in enumerate(temp_files):
-            try:
-                print(f"Integrando archivo {i+1}/{len(temp_files)}: {temp_file}")
-                content = (
-                    s3_client.get_object(Bucket=bucket, Key=temp_file)["Body"]
-                    .read()
-                    .decode("utf-8")
-                )
-
-                df = pd.read_csv(io.StringIO(content))
+        with S3MultipartWriter(bucket, final_path) as writer:
+            for i, temp_file in enumerate(temp_files):
+                try:
+                    print(f"Integrando archivo {i+1}/{len(temp_files)}: {temp_file}")
+                    response = s3_client.get_object(Bucket=bucket, Key=temp_file)
+                    df = pd.read_csv(response["Body"])
 
-                # Normalización de esquema para consistencia
-                for col in ordered_columns:
-                    if col not in df.columns:
-                        df[col] = None
+                    # Normalización de esquema para consistencia
+                    for col in ordered_columns:
+                        if col not in df.columns:
+                            df[col] = None
 
-                # Aplicar orden unificado de columnas
-                df = df[ordered_columns]
+                    # Aplicar orden unificado de columnas
+                    df = df[ordered_columns]
 
-                # Escritura incremental manteniendo integridad estructural
-                if i == 0:
-                    write_csv_s3(df, bucket, final_path)
-                else:
+                    # El encabezado solo se escribe en la primera parte
                     with io.StringIO() as csv_buffer:
-                        df.to_csv(csv_buffer, index=False, header=False)
-                        csv_buffer.seek(0)
-                        append_content = csv_buffer.getvalue()
-
-                        if append_content.strip():
-                            existing_content = (
-                                s3_client.get_object(Bucket=bucket, Key=final_path)[
-                                    "Body"
-                                ]
-                                .read()
-                                .decode("utf-8")
-                            )
-                            s3_client.put_object(
-                                Bucket=bucket,
-                                Key=final_path,
-                                Body=existing_content + append_content,
-                            )
-
-                total_rows_processed += len(df)
-                print(
-                    f"Progreso: {len(df)} filas añadidas. Acumulado: {total_rows_processed} filas"
-                )
+                        df.to_csv(csv_buffer, index=False, header=write_header)
+                        writer.write(csv_buffer.getvalue().encode("utf-8"))
+                    write_header = False
 
-                del df
-                gc.collect()
+                    total_rows_processed += len(df)
+                    print(
+                        f"Progreso: {len(df)} filas añadidas. Acumulado: {total_rows_processed} filas"
+                    )
 
-            except Exception as e:
-                logging.error(f"Error en procesamiento de {temp_file}: {str(e)}")
+                    del df
+                    gc.collect()
+
+                except Exception as e:
+                    logging.error(f"Error en procesamiento de {temp_file}: {str(e)}")
 
         # Fase 4: Verificación de integridad estructural final
         try: